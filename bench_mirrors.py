@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Стенд для замеров выбора зеркала: поднимает N локальных HTTP-серверов на
+127.0.0.1 с синтетическим деревом dists/kali-rolling (InRelease и
+Packages.gz), у каждого — своя задержка, предел скорости, разброс задержки,
+доля ошибок и, по желанию, устаревший InRelease. Прогоняет на них
+rank_mirrors из kali_mirror_gui (быстрая проверка и турнир), меряет время,
+потраченные байты, как часто первым выбрано действительно лучшее зеркало
+и как быстро проверка останавливается по отмене. Там же — проверка
+кэширующего прокси (--serve-cache) с зеркалом стенда в роли источника. Итог — JSON-отчёт, который
+можно сравнить с отчётом другой версии (--baseline).
+
+    python3 bench_mirrors.py --mirrors 8 --rounds 3 --report bench.json
+    python3 bench_mirrors.py --profiles farm.json --baseline old.json
+"""
+import sys
+import os
+import json
+import math
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+import platform
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import kali_mirror_gui as kmg
+
+# === Настройки ===
+FARM_SIZE = 8                        # Зеркал на стенде
+FARM_SEED = 1                        # Профили зеркал генерируются из этого seed
+ROUNDS = 3                           # Повторов каждого замера
+INDEX_SIZE = 4 * 1024 * 1024         # Размер синтетического Packages.gz, байт
+SEND_CHUNK = 16 * 1024               # Сервер пишет тело такими кусками, выдерживая свою скорость
+STALE_AGE = 2 * 24 * 3600            # Насколько отстаёт InRelease устаревшего зеркала, сек
+CANCEL_AFTER = 0.5                   # Через сколько секунд после начала проверки жмём «Отмена»
+MODES = ("quick", "benchmark")       # Режимы rank_mirrors: BENCHMARK_MODE = False / True
+DEB_FILE = "pool/main/b/bench/bench_1.0_amd64.deb"  # Пакет, который качают через прокси
+DEB_SIZE = 256 * 1024
+PROXY_CLIENTS = 8                    # Одновременных клиентов прокси
+
+
+# === Зеркала стенда ===
+class FarmMirror:
+    """
+    Один сервер стенда. profile — dict: latency (сек до ответа), bandwidth
+    (байт/с на соединение), jitter (сек, добавка к задержке от 0 до jitter),
+    error_rate (доля ответов 503), stale (InRelease отстаёт на STALE_AGE).
+    """
+
+    def __init__(self, profile, payload, seed):
+        self.profile = profile
+        self.payload = payload
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/kali"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.bytes_sent = 0
+            self.requests = 0
+
+    def count(self, sent=0, request=False):
+        with self.lock:
+            self.bytes_sent += sent
+            self.requests += request
+
+    def roll(self):
+        """(ответить ошибкой?, задержка ответа) для очередного запроса."""
+        with self.lock:
+            failed = self.random.random() < self.profile.get("error_rate", 0)
+            delay = self.profile["latency"] + self.random.uniform(0, self.profile.get("jitter", 0))
+        return failed, delay
+
+    def in_release(self):
+        """Неподписанный InRelease: rank_mirrors читает из него только Date и Valid-Until."""
+        date = time.time() - (STALE_AGE if self.profile.get("stale") else 0)
+        return (f"Origin: Kali\nSuite: kali-rolling\nCodename: kali-rolling\n"
+                f"Date: {formatdate(date, usegmt=True)}\n"
+                f"Valid-Until: {formatdate(date + 7 * 86400, usegmt=True)}\n"
+                f"Architectures: amd64\nComponents: {' '.join(kmg.KALI_COMPONENTS)}\n").encode()
+
+    def handler_class(self):
+        mirror = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, fmt, *args):
+                pass
+
+            def do_GET(self):
+                mirror.count(request=True)
+                failed, delay = mirror.roll()
+                time.sleep(delay)
+                if self.path == f"/kali/{kmg.RELEASE_FILE}":
+                    body = mirror.in_release()
+                elif self.path == f"/kali/{kmg.BENCH_FILE}":
+                    body = mirror.payload
+                elif self.path == f"/kali/{DEB_FILE}":
+                    body = mirror.payload[:DEB_SIZE]
+                else:
+                    failed, body = False, None
+                if failed or body is None:
+                    self.send_response(503 if failed else 404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status, start, end = 200, 0, len(body) - 1
+                rng = self.headers.get("Range", "")
+                if rng.startswith("bytes="):
+                    first, _, last = rng[6:].partition("-")
+                    start = int(first or 0)
+                    end = min(int(last), end) if last else end
+                    status = 206
+                self.send_response(status)
+                self.send_header("Content-Length", str(end - start + 1))
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+                self.end_headers()
+                try:
+                    self.send_body(memoryview(body)[start:end + 1])
+                except (ConnectionError, OSError):
+                    self.close_connection = True
+
+            def send_body(self, data):
+                """Пишет data кусками SEND_CHUNK не быстрее bandwidth."""
+                rate = mirror.profile["bandwidth"]
+                started = time.monotonic()
+                sent = 0
+                while sent < len(data):
+                    chunk = data[sent:sent + SEND_CHUNK]
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    mirror.count(len(chunk))
+                    ahead = sent / rate - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        return Handler
+
+
+def default_profiles(count, seed):
+    """
+    Профили для стенда из count зеркал. Кроме случайных, две ловушки: самое
+    быстрое, но устаревшее зеркало и быстрое, но отвечающее ошибкой через раз.
+    """
+    rng = random.Random(seed)
+    profiles = []
+    for _ in range(count):
+        profiles.append({
+            "latency": round(rng.uniform(0.005, 0.15), 3),
+            # Скорости от 256 КБ/с до 16 МБ/с, равномерно по порядку величины
+            "bandwidth": int(2 ** rng.uniform(18, 24)),
+            "jitter": round(rng.uniform(0, 0.02), 3),
+            "error_rate": 0.0,
+            "stale": False,
+        })
+    if count >= 4:
+        profiles[0].update(latency=0.003, bandwidth=32 * 1048576, stale=True)
+        profiles[1].update(latency=0.004, bandwidth=24 * 1048576, error_rate=0.5)
+    return profiles
+
+
+def expected_seconds(profile):
+    """
+    Сколько в среднем займёт у зеркала загрузка файла BENCH_REF_SIZE — по той
+    же формуле, что score_benchmark, но по настоящему профилю, а не замеру.
+    Устаревшее зеркало не годится вовсе.
+    """
+    if profile.get("stale"):
+        return math.inf
+    seconds = kmg.BENCH_WEIGHTS["ttfb"] * (profile["latency"] + profile.get("jitter", 0) / 2)
+    return seconds + kmg.BENCH_WEIGHTS["throughput"] * kmg.BENCH_REF_SIZE / profile["bandwidth"]
+
+
+def true_order(farm):
+    """
+    Зеркала стенда от действительно лучшего: сначала надёжные по expected_seconds,
+    за ними отвечающие ошибками — на таком apt спотыкается, как бы быстро оно ни было.
+    """
+    order = sorted(farm, key=lambda m: (m.profile.get("error_rate", 0) > 0, expected_seconds(m.profile)))
+    return [mirror.url for mirror in order]
+
+
+# === Замеры ===
+class Bench:
+    def __init__(self, farm, verbose=False):
+        self.farm = farm
+        self.workdir = tempfile.mkdtemp(prefix="kali-mirror-bench-")
+        # Лог и кэш оценок — во временном каталоге, реальные файлы не трогаем
+        kmg.LOG_FILE = os.path.join(self.workdir, "bench.log")
+        kmg.USER_MIRRORS_FILE = os.path.join(self.workdir, "mirrors.txt")
+        self.app = kmg.MirrorApp(None, require_root=False)
+        if not verbose:
+            self.app.log = logging.info
+        self.mirrors = [mirror.url for mirror in farm]
+        self.truth = true_order(farm)
+
+    def rank(self, mode):
+        """Один прогон rank_mirrors с пустым кэшем оценок: (время, рейтинг, байт, запросов)."""
+        kmg.BENCHMARK_MODE = mode == "benchmark"
+        scores = kmg.ScoreCache(os.path.join(self.workdir, f"scores-{time.monotonic_ns()}.json"))
+        self.app.cancel_event.clear()
+        self.app.link_ceiling = 0.0
+        self.app.solo_rates = {}
+        for mirror in self.farm:
+            mirror.reset()
+        start = time.perf_counter()
+        ranked = self.app.rank_mirrors(self.mirrors, scores, refresh=True)
+        wall = time.perf_counter() - start
+        spent = sum(mirror.bytes_sent for mirror in self.farm)
+        requests = sum(mirror.requests for mirror in self.farm)
+        return wall, [mirror for _, mirror in ranked], spent, requests
+
+    def ranking_run(self, mode, rounds):
+        runs = []
+        for _ in range(rounds):
+            wall, ranked, spent, requests = self.rank(mode)
+            runs.append({
+                "wall": round(wall, 4),
+                "bytes": spent,
+                "requests": requests,
+                "chosen": ranked[0] if ranked else None,
+                # Место действительно лучшего зеркала в рейтинге (0 — первое), None — выпало
+                "truth_rank": ranked.index(self.truth[0]) if self.truth[0] in ranked else None,
+            })
+        stale = {mirror.url for mirror in self.farm if mirror.profile.get("stale")}
+        flaky = {mirror.url for mirror in self.farm if mirror.profile.get("error_rate", 0) > 0}
+        ranks = [run["truth_rank"] for run in runs if run["truth_rank"] is not None]
+        return {
+            "runs": runs,
+            "wall_mean": round(sum(run["wall"] for run in runs) / len(runs), 4),
+            "bytes_mean": sum(run["bytes"] for run in runs) // len(runs),
+            "hit_rate": sum(run["chosen"] == self.truth[0] for run in runs) / len(runs),
+            "truth_rank_mean": round(sum(ranks) / len(ranks), 2) if ranks else None,
+            "stale_chosen": sum(run["chosen"] in stale for run in runs),
+            "flaky_chosen": sum(run["chosen"] in flaky for run in runs),
+        }
+
+    def cancel_run(self, rounds, after=CANCEL_AFTER):
+        """Время от cancel_event до возврата rank_mirrors (турнир — самый долгий режим)."""
+        latencies = []
+        for _ in range(rounds):
+            done = threading.Event()
+            thread = threading.Thread(target=lambda: (self.rank("benchmark"), done.set()), daemon=True)
+            thread.start()
+            if done.wait(after):
+                # Проверка закончилась раньше, чем её успели отменить
+                continue
+            start = time.perf_counter()
+            self.app.cancel_event.set()
+            thread.join()
+            latencies.append(round(time.perf_counter() - start, 4))
+        self.app.cancel_event.clear()
+        return {
+            "after": after,
+            "latency": latencies,
+            "latency_mean": round(sum(latencies) / len(latencies), 4) if latencies else None,
+            "latency_max": max(latencies) if latencies else None,
+        }
+
+
+    def proxy_run(self, clients=PROXY_CLIENTS):
+        """
+        Кэширующий прокси поверх самого медленного надёжного зеркала стенда:
+        clients одновременных запросов одного .deb должны получить его целиком
+        за одну загрузку с зеркала, повторный запрос — из кэша, без зеркала.
+        """
+        reliable = [m for m in self.farm if not m.profile.get("error_rate") and not m.profile.get("stale")]
+        upstream = min(reliable or self.farm, key=lambda m: m.profile["bandwidth"])
+        store = kmg.CacheStore(os.path.join(self.workdir, f"cache-{time.monotonic_ns()}"))
+        proxy = kmg.CachingProxy(self.app, store, [upstream.url])
+        server = ThreadingHTTPServer(("127.0.0.1", 0), proxy.handler_class())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/{DEB_FILE}"
+        expected = upstream.payload[:DEB_SIZE]
+
+        def fetch(delay):
+            time.sleep(delay)
+            try:
+                with urllib.request.urlopen(url, timeout=60) as resp:
+                    return resp.read() == expected
+            except Exception:
+                return False
+
+        try:
+            upstream.reset()
+            start = time.perf_counter()
+            # Клиенты приходят вразнобой, пока первая загрузка ещё идёт
+            spread = DEB_SIZE / upstream.profile["bandwidth"]
+            with ThreadPoolExecutor(clients) as pool:
+                complete = sum(pool.map(fetch, [spread * i / clients for i in range(clients)]))
+            wall = time.perf_counter() - start
+            upstream_requests = upstream.requests
+            upstream.reset()
+            cached = fetch(0) and upstream.requests == 0
+        finally:
+            server.shutdown()
+            server.server_close()
+        return {
+            "clients": clients,
+            "complete": complete,
+            "upstream_requests": upstream_requests,
+            "cache_hit": cached,
+            "wall": round(wall, 4),
+        }
+
+
+def git_version():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.run(["git", "-C", here, "describe", "--always", "--dirty"],
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(report, baseline):
+    """Печатает изменения основных метрик против отчёта baseline."""
+    print(f"[+] Сравнение с {baseline.get('version') or 'базовым отчётом'}:")
+    for mode in MODES:
+        old, new = baseline.get("results", {}).get(mode), report["results"].get(mode)
+        if not old or not new:
+            continue
+        for key in ("wall_mean", "bytes_mean", "hit_rate"):
+            if old.get(key):
+                change = (new[key] - old[key]) / old[key] * 100
+                print(f"    {mode:9} {key:10} {old[key]} → {new[key]} ({change:+.0f}%)")
+    old, new = baseline.get("results", {}).get("cancel", {}), report["results"]["cancel"]
+    if old.get("latency_max") and new["latency_max"] is not None:
+        print(f"    cancel    latency_max {old['latency_max']} → {new['latency_max']}")
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Стенд замеров выбора зеркала kali_mirror_gui")
+    parser.add_argument("--mirrors", type=int, default=FARM_SIZE, help="зеркал на стенде")
+    parser.add_argument("--seed", type=int, default=FARM_SEED, help="seed для профилей и ошибок")
+    parser.add_argument("--profiles", help="JSON-список профилей зеркал вместо сгенерированных")
+    parser.add_argument("--rounds", type=int, default=ROUNDS, help="повторов каждого замера")
+    parser.add_argument("--cancel-after", type=float, default=CANCEL_AFTER,
+                        help="через сколько секунд отменять проверку в замере отмены")
+    parser.add_argument("--report", default="bench-report.json", help="куда записать JSON-отчёт")
+    parser.add_argument("--baseline", help="JSON-отчёт прошлой версии для сравнения")
+    parser.add_argument("--verbose", action="store_true", help="показывать лог проверок")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profiles:
+        with open(args.profiles) as f:
+            profiles = json.load(f)
+    else:
+        profiles = default_profiles(args.mirrors, args.seed)
+    payload = random.Random(args.seed).randbytes(INDEX_SIZE)
+    farm = [FarmMirror(profile, payload, args.seed + i) for i, profile in enumerate(profiles)]
+    for mirror in farm:
+        mirror.start()
+    try:
+        bench = Bench(farm, verbose=args.verbose)
+        print(f"[+] Стенд: {len(farm)} зеркал, лучшее — {bench.truth[0]}")
+        results = {}
+        for mode in MODES:
+            results[mode] = bench.ranking_run(mode, args.rounds)
+            r = results[mode]
+            print(f"    {mode:9} {r['wall_mean']:.2f} с, {r['bytes_mean'] // 1024} КБ, "
+                  f"лучшее выбрано в {r['hit_rate'] * 100:.0f}% прогонов, "
+                  f"устаревшее — {r['stale_chosen']}, с ошибками — {r['flaky_chosen']} раз")
+        results["proxy"] = bench.proxy_run()
+        r = results["proxy"]
+        print(f"    прокси    целиком у {r['complete']} из {r['clients']} клиентов, "
+              f"запросов к зеркалу {r['upstream_requests']}, повтор из кэша: {'да' if r['cache_hit'] else 'нет'}")
+        results["cancel"] = bench.cancel_run(args.rounds, args.cancel_after)
+        if results["cancel"]["latency"]:
+            print(f"    отмена    до {results['cancel']['latency_max'] * 1000:.0f} мс")
+        else:
+            print(f"    отмена    проверка кончается быстрее {args.cancel_after} с — не замерить")
+    finally:
+        for mirror in farm:
+            mirror.stop()
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "settings": {"rounds": args.rounds, "seed": args.seed, "index_size": INDEX_SIZE,
+                     "bench_bytes": kmg.BENCH_BYTES, "probe_bytes": kmg.PROBE_BYTES,
+                     "tournament_rounds": kmg.TOURNAMENT_ROUNDS},
+        "mirrors": [dict(mirror.profile, url=mirror.url,
+                         expected_seconds=round(expected_seconds(mirror.profile), 4)
+                         if math.isfinite(expected_seconds(mirror.profile)) else None)
+                    for mirror in farm],
+        "truth": bench.truth,
+        "results": results,
+    }
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"[OK] Отчёт: {args.report}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
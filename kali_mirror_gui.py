@@ -5,23 +5,50 @@ import os
 # Добавляем ./lib в путь поиска модулей
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "lib"))
 
-try:
-    import tkinter as tk
-    from tkinter import ttk, messagebox, simpledialog
-    GUI_AVAILABLE = True
-except ImportError:
-    GUI_AVAILABLE = False
+# Тяжёлые модули (tkinter, requests, asyncio, ssl, http.client, http.server)
+# импортируются там, где нужны: запуск без окна (--rerank-once из cron)
+# не должен платить за них. Бюджет проверяет --startup-report.
+GUI_AVAILABLE = False    # Выставляет load_gui()
 
 import subprocess
+import selectors
+import signal
+import codecs
 import threading
 import time
 import shutil
 import logging
-import requests
+import collections
+import mmap
+import queue
+import atexit
+import functools
+import contextlib
+import glob
+import json
+import hashlib
+import re
+import tempfile
+import math
+import socket
+from urllib.parse import urlsplit, urljoin, unquote
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # === Настройки ===
 LOG_FILE = "/var/log/kali-mirror-gui.log"
+USER_LOG_FILE = os.path.expanduser("~/.cache/kali-mirror-gui/kali-mirror-gui.log")  # Без root (--serve-cache)
 USER_MIRRORS_FILE = os.path.expanduser("~/.config/kali-mirror-gui/mirrors.txt")
+SCORES_FILE = os.path.join(os.path.dirname(USER_MIRRORS_FILE), "scores.json")
+DAEMON_STATE_FILE = os.path.join(os.path.dirname(USER_MIRRORS_FILE), "daemon.json")
+INSTALL_STATS_FILE = os.path.join(os.path.dirname(USER_MIRRORS_FILE), "install_times.json")
+# "mirrorlist" — в sources.list метод mirror+file: apt сам переключается между зеркалами
+# из MIRROR_LIST_FILE и делит загрузки между равными; "single" — одно зеркало, как раньше;
+# "sharded" — компоненты с разных зеркал с одинаковым InRelease: apt качает с нескольких хостов сразу
+SOURCES_MODE = "mirrorlist"
+MIRROR_LIST_FILE = "/etc/apt/mirrors/kali.list"
+MIRROR_LIST_SIZE = 5     # Зеркал в списке
+SHARD_MIRRORS = 3        # Хостов в режиме "sharded"
+KALI_COMPONENTS = ["main", "contrib", "non-free", "non-free-firmware"]
 DEFAULT_MIRRORS = [
     "https://http.kali.org/kali",
     "http://ftp.halifax.rwth-aachen.de/kali",
@@ -29,26 +56,909 @@ DEFAULT_MIRRORS = [
     "http://mirror.csclub.uwaterloo.ca/kali",
     "http://kali.download/kali"
 ]
+PROBE_CONCURRENCY = 16   # Сколько зеркал проверяем одновременно
+PROBE_DEADLINE = 20      # Общий лимит на проверку всех зеркал, сек
+LOG_FLUSH_MS = 50        # Как часто окно забирает накопленные строки лога, мс
+LOG_MAX_LINES_PER_TICK = 500  # Не больше стольких строк за один проход
+CONSOLE_MAX_LINES = 5000  # Строк в окне лога; полный лог — в LOG_FILE
+CONSOLE_TRIM_CHUNK = 500  # Лишние строки удаляем из окна пачками
+LOG_PAGE_BYTES = 64 * 1024  # Размер страницы при просмотре полного лога
+
+PROCESS_KILL_GRACE = 3   # Через столько секунд после SIGTERM группа процессов получает SIGKILL
+CANCEL_POLL = 0.05       # Как часто run_cmd проверяет отмену, сек
+
+PROBE_BACKEND = "threads"  # "asyncio" — все проверки в одном цикле событий (сотни зеркал)
+ASYNC_PROBE_LIMIT = 500  # Одновременных проверок в asyncio-режиме
+PROBE_BYTES = 10240      # Сколько байт Packages.gz качаем при быстрой проверке
+POOL_HOSTS = 64          # Сколько хостов держим в пуле соединений Session
+
+# Подробный замер (benchmark): задержки и устойчивая скорость отдельно
+BENCHMARK_MODE = True                # False — ранжировать по быстрому test_mirror
+BENCH_FILE = "dists/kali-rolling/main/binary-amd64/Packages.gz"
+BENCH_BYTES = 1024 * 1024            # Бюджет байт на замер скорости...
+BENCH_WINDOW = 5                     # ...или окно времени, сек (что наступит раньше)
+BENCH_REF_SIZE = 512 * 1024          # «Типичный» файл, для которого считаем итоговый балл
+BENCH_WEIGHTS = {"dns": 0.2, "connect": 0.5, "tls": 0.5, "ttfb": 1.0, "throughput": 1.0}
+MAX_REDIRECTS = 3
+
+# Отбор по турнирной схеме (successive halving)
+TOURNAMENT_ROUNDS = 3                # Раундов, считая первый; 2 — после отсева по задержке сразу полный замер
+TOURNAMENT_KEEP = 0.5                # Доля зеркал, проходящих в следующий раунд
+TOURNAMENT_MIN_KEEP = 2              # Меньше стольких финалистов не оставляем
+LATENCY_PROBE_BYTES = 4096           # Первый раунд — задержка и начало InRelease, почти без трафика
+LATENCY_PROBE_CONCURRENCY = 64       # Замеры задержки канал не делят — запускаем широко
+BANDWIDTH_GROUP = 3                  # Замеры скорости — группами не больше стольких зеркал
+LINK_SATURATION = 0.8                # Доля потолка канала, при которой зеркало «упирается» в канал
+
+# Свежесть зеркал по полям Date / Valid-Until из InRelease
+RELEASE_FILE = "dists/kali-rolling/InRelease"
+FRESHNESS_MAX_LAG = 12 * 3600        # Допустимое отставание от самого свежего зеркала, сек
+FRESHNESS_POLICY = "drop"            # "drop" — исключить, "penalize" — только в конец списка
+
+# apt-get update лучших зеркал параллельно, в изолированных каталогах
+VALIDATE_TOP_N = 3
+APT_LISTS_DIR = "/var/lib/apt/lists"
+# Блокировки apt (fcntl, как в самом apt): lists — apt-get update, lock-frontend — upgrade/install
+APT_LOCK_FILES = [os.path.join(APT_LISTS_DIR, "lock"), "/var/lib/dpkg/lock-frontend"]
+# Символы, которые apt экранирует как %xx в именах файлов lists (URItoFileName)
+APT_QUOTE_CHARS = "\\|{}[]<>\"^~_=!@#$%^&*"
+# Сжатие, в котором apt хранит индексы в lists
+APT_LIST_COMPRESSION = (".lz4", ".gz", ".xz", ".bz2", ".zst", ".lzma")
+# Предзагрузка .deb для apt-get upgrade сразу с нескольких зеркал
+PARALLEL_DOWNLOAD = True
+DOWNLOAD_MIRRORS = 3                 # С какого числа лучших зеркал качаем
+DOWNLOAD_WORKERS = 8                 # Одновременных загрузок
+RANGE_SPLIT_SIZE = 32 * 1024 * 1024  # Файлы больше этого качаем частями...
+RANGE_PART_SIZE = 16 * 1024 * 1024   # ...вот такого размера (Range-запросами)
+APT_ARCHIVES_DIR = "/var/cache/apt/archives"
+APT_ARCHIVES_LOCK = os.path.join(APT_ARCHIVES_DIR, "lock")  # apt держит её, пока качает пакеты
+
+# Выбор зеркала под предстоящее обновление: замер на тех же .deb, что скачает apt-get upgrade
+WORKLOAD_SELECTION = True
+WORKLOAD_CANDIDATES = 5              # Сколько лучших зеркал рейтинга сравниваем
+WORKLOAD_SAMPLE = 4                  # Сколько пакетов из обновления качаем для замера
+WORKLOAD_SAMPLE_BYTES = 256 * 1024   # Не больше стольких байт с каждого
+
+# Быстрая установка (по желанию): dpkg без fsync на каждый файл, триггеры — одним проходом в конце
+FAST_INSTALL = False
+FAST_INSTALL_OPTIONS = [
+    "-o", "Dpkg::Options::=--force-unsafe-io",
+    "-o", "DPkg::NoTriggers=true",
+    "-o", "DPkg::ConfigurePending=true",
+    "-o", "DPkg::TriggersPending=true",
+]
+FAST_INSTALL_FS = ("ext4", "ext3", "xfs", "btrfs", "f2fs")  # Корневые ФС, где это безопасно после sync
+INSTALL_RATE_MEMORY = 0.7            # Вес прошлых замеров в средней скорости установки
+
+# Кэширующий прокси для лаборатории из нескольких машин (--serve-cache)
+CACHE_DIR = "/var/cache/kali-mirror-gui"
+CACHE_MAX_BYTES = 20 * 1024 ** 3     # Больше — вытесняем давно не запрошенные файлы
+CACHE_PROXY_PORT = 3142
+
+# Фоновая служба (--daemon, --rerank-once)
+DAEMON_INTERVAL = 3600               # Как часто служба заново оценивает зеркала, сек
+DAEMON_PROBE_CONCURRENCY = 2         # В фоне проверяем зеркала по одному-два, чтобы не мешать
+DAEMON_PROBE_DEADLINE = 300          # ...зато даём на проверку больше времени
+SWITCH_MARGIN = 0.2                  # Меняем зеркало, только если новое лучше на 20%
+RUN_LOCK_FILE = "/run/kali-mirror-gui.lock"  # Обновление из окна и смена зеркала службой не идут одновременно
+
+# Сигнатуры ошибок в выводе apt-get update: (тип, регулярное выражение, фатальна ли).
+# На первой фатальной apt-get update прерывается, и пробуется следующее зеркало.
+APT_ERROR_TAXONOMY = [
+    ("fetch", r"Failed to fetch|Не удалось получить|^Err:\d+|^Ошб:\d+", True),
+    ("hash", r"Hash Sum mismatch|Несовпадение хэш-сумм|File has unexpected size|Файл имеет неожиданный размер", True),
+    ("not_found", r"\b404\s+Not Found", True),
+    ("expired", r"is expired|is not valid yet|просрочен|ещё не действителен", True),
+    ("timeout", r"timed out|timeout|время ожидания", True),
+]
+
+# Кэш оценок зеркал
+SCORE_TTL = 6 * 3600                 # Столько секунд свежая оценка избавляет от повторной проверки
+SCORE_HALF_LIFE = 24 * 3600          # За это время вес старых замеров падает вдвое
+SCORE_MEMORY = 0.5                   # Вес старого значения, если замеры сделаны подряд
+
+# Бюджет времени запуска (--startup-report): импорт модуля, мс
+STARTUP_BUDGET_MS = 100
 
 # === Логирование ===
-os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-os.makedirs(os.path.dirname(USER_MIRRORS_FILE), exist_ok=True)
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    encoding="utf-8"
-)
+LOG_LISTENER = None
+
+
+def setup_logging():
+    """
+    Открывает LOG_FILE при создании первого MirrorApp, а не при импорте.
+    Запись в файл — в фоновом потоке: вызывающий только кладёт запись в очередь.
+    Без прав на LOG_FILE (--serve-cache не от root) пишем в USER_LOG_FILE,
+    а если нельзя и туда — в stderr.
+    """
+    global LOG_LISTENER, LOG_FILE
+    if LOG_LISTENER:
+        return
+    import logging.handlers
+    try:
+        os.makedirs(os.path.dirname(USER_MIRRORS_FILE), exist_ok=True)
+    except OSError:
+        pass
+    file_handler = None
+    for path in (LOG_FILE, USER_LOG_FILE):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_handler = logging.FileHandler(path, encoding="utf-8")
+            LOG_FILE = path
+            break
+        except OSError:
+            continue
+    file_handler = file_handler or logging.StreamHandler()
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    records = queue.SimpleQueue()
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(records))
+    logging.getLogger().setLevel(logging.INFO)
+    LOG_LISTENER = logging.handlers.QueueListener(records, file_handler)
+    LOG_LISTENER.start()
+    atexit.register(LOG_LISTENER.stop)
+
+
+def load_gui():
+    """Импортирует tkinter — только для оконного режима. True, если он доступен."""
+    global GUI_AVAILABLE, tk, ttk, messagebox, simpledialog
+    try:
+        import tkinter as tk
+        from tkinter import ttk, messagebox, simpledialog
+        GUI_AVAILABLE = True
+    except ImportError:
+        GUI_AVAILABLE = False
+    return GUI_AVAILABLE
+
+
+# === Кэш оценок зеркал ===
+class ScoreCache:
+    """
+    Оценки зеркал на диске (SCORES_FILE): скорость, задержка, число
+    неудач и время последнего замера. Новые замеры смешиваются со старыми,
+    вес которых экспоненциально убывает с возрастом (SCORE_HALF_LIFE).
+    """
+
+    def __init__(self, path=None):
+        self.path = path or SCORES_FILE
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # Без записи кэша (нет прав на домашний каталог) просто проверим зеркала заново в следующий раз
+            logging.warning("Не удалось сохранить %s: %s", self.path, e)
+
+    def _decay(self, entry, now):
+        """Множитель веса для замеров в entry, сделанных до момента now."""
+        return math.exp(-math.log(2) * max(0.0, now - entry.get("ts", 0)) / SCORE_HALF_LIFE)
+
+    def record(self, mirror, score, throughput=None, latency=None):
+        now = time.time()
+        entry = self.entries.setdefault(mirror, {})
+        decay = self._decay(entry, now)
+        keep = SCORE_MEMORY * decay
+        for key, value in (("score", score), ("throughput", throughput), ("latency", latency)):
+            if value is None:
+                continue
+            old = entry.get(key)
+            entry[key] = value if old is None else keep * old + (1 - keep) * value
+        entry["failures"] = entry.get("failures", 0.0) * decay
+        entry["ok"] = True
+        entry["ts"] = now
+
+    def record_failure(self, mirror):
+        now = time.time()
+        entry = self.entries.setdefault(mirror, {})
+        entry["failures"] = entry.get("failures", 0.0) * self._decay(entry, now) + 1
+        entry["ok"] = False
+        entry["ts"] = now
+
+    def is_fresh(self, mirror):
+        """Последняя проверка была успешной и не старше SCORE_TTL."""
+        entry = self.entries.get(mirror)
+        return bool(entry and entry.get("ok") and time.time() - entry["ts"] < SCORE_TTL)
+
+    def score(self, mirror):
+        """Оценка из кэша с поправкой на недавние неудачи."""
+        entry = self.entries.get(mirror, {})
+        return entry.get("score", 0.0) / (1 + entry.get("failures", 0.0))
+
+    def ranking(self, mirrors):
+        """Список (балл, зеркало) только по кэшу, от лучшего к худшему."""
+        return sorted(((self.score(mirror), mirror) for mirror in mirrors),
+                      key=lambda x: x[0], reverse=True)
+
+
+# === Замеры зеркал без requests ===
+class ProbeClient:
+    """
+    Лёгкий HTTP-клиент для замеров: http.client поверх своего сокета, без
+    Session, cookies, хуков и декодирования ответа. Тело читается через
+    readinto в заранее выделенный буфер (свой у каждого потока), фазы
+    (DNS, TCP, TLS, TTFB, передача) отмечаются time.perf_counter_ns.
+    Соединения, оставленные запросами с reuse, общие для всех потоков и
+    живут до close().
+    """
+
+    def __init__(self, ssl_context, buffer_size=65536):
+        self.ssl_context = ssl_context
+        self.buffer_size = buffer_size
+        self.local = threading.local()
+        # (схема, хост:порт) → свободное HTTPConnection
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def buffer(self):
+        if not hasattr(self.local, "buffer"):
+            self.local.buffer = memoryview(bytearray(self.buffer_size))
+        return self.local.buffer
+
+    def close(self):
+        """Закрывает все свободные соединения."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conn in idle.values():
+            conn.close()
+
+    def fetch(self, url, byte_budget, window=None, timeout=8, keep_body=False, reuse=False,
+              cancel_event=None):
+        """
+        GET url с Range на первые byte_budget байт; редиректы (до MAX_REDIRECTS)
+        проходятся вручную, время фаз суммируется. Тело читается не дольше
+        window секунд. С reuse запрос берёт свободное соединение с тем же
+        хостом, а своё, если ответ дочитан, оставляет открытым для следующего.
+        Возвращает dict с dns, connect, tls, ttfb, transfer (секунды), bytes,
+        throughput (байт/с после первого байта) и "body" при keep_body;
+        None при ошибке или ответе не 200/206.
+        """
+        ns = {"dns": 0, "connect": 0, "tls": 0, "ttfb": 0}
+        headers = {"Range": f"bytes=0-{byte_budget - 1}", "User-Agent": "kali-mirror-gui"}
+        conn = None
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                conn, resp = self.request(url, headers, ns, timeout, reuse)
+                if resp.status not in (301, 302, 303, 307, 308):
+                    break
+                resp.read()
+                self.finish(url, conn, resp, reuse)
+                conn = None
+                url = urljoin(url, resp.getheader("Location", ""))
+            else:
+                return None
+            if resp.status not in (200, 206):
+                return None
+
+            buf = self.buffer()
+            body = bytearray() if keep_body else None
+            received = 0
+            start = time.perf_counter_ns()
+            limit = start + int(window * 1e9) if window else None
+            while received < byte_budget:
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                if limit and time.perf_counter_ns() >= limit:
+                    break
+                n = resp.readinto(buf[:min(len(buf), byte_budget - received)])
+                if not n:
+                    break
+                if keep_body:
+                    body += buf[:n]
+                received += n
+            transfer = time.perf_counter_ns() - start
+            if not received or transfer <= 0:
+                return None
+            result = {phase: value / 1e9 for phase, value in ns.items()}
+            result.update(transfer=transfer / 1e9, bytes=received, throughput=received * 1e9 / transfer)
+            if keep_body:
+                result["body"] = bytes(body)
+            self.finish(url, conn, resp, reuse)
+            conn = None
+            return result
+        except Exception:
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def request(self, url, headers, ns, timeout, reuse):
+        """Отправляет GET и читает заголовки ответа, добавляя в ns время каждой фазы."""
+        import http.client
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers, Host=parts.netloc)
+        conn = None
+        if reuse:
+            with self.lock:
+                conn = self.idle.pop((parts.scheme, parts.netloc), None)
+        if conn:
+            try:
+                t0 = time.perf_counter_ns()
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                ns["ttfb"] += time.perf_counter_ns() - t0
+                return conn, resp
+            except (OSError, http.client.HTTPException):
+                # Сервер уже закрыл простаивавшее соединение — открываем новое
+                conn.close()
+
+        https = parts.scheme == "https"
+        host = parts.hostname
+        port = parts.port or (443 if https else 80)
+        t0 = time.perf_counter_ns()
+        family, socktype, proto, _, addr = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+        t1 = time.perf_counter_ns()
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(addr)
+            t2 = time.perf_counter_ns()
+            if https:
+                sock = self.ssl_context().wrap_socket(sock, server_hostname=host)
+            t3 = time.perf_counter_ns()
+        except Exception:
+            sock.close()
+            raise
+
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        conn.sock = sock
+        try:
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+        t4 = time.perf_counter_ns()
+        ns["dns"] += t1 - t0
+        ns["connect"] += t2 - t1
+        ns["tls"] += t3 - t2
+        ns["ttfb"] += t4 - t3
+        return conn, resp
+
+    def finish(self, url, conn, resp, reuse):
+        """Оставляет conn открытым для повторного запроса или закрывает его."""
+        if reuse and resp.isclosed() and not resp.will_close:
+            parts = urlsplit(url)
+            with self.lock:
+                # Одного свободного соединения на хост достаточно
+                if (parts.scheme, parts.netloc) not in self.idle:
+                    self.idle[(parts.scheme, parts.netloc)] = conn
+                    return
+        conn.close()
+
+
+# === Асинхронные проверки зеркал ===
+class AsyncProber:
+    """
+    Проверки зеркал на неблокирующих сокетах (asyncio streams) — с тем же
+    интерфейсом и результатами, что test_mirror / benchmark_mirror /
+    probe_release у MirrorApp, но корутинами. Каждая фаза (DNS, TCP, TLS,
+    заголовки, чтение) ограничена своим таймаутом.
+    """
+
+    def __init__(self, app, timeout=8):
+        self.app = app
+        self.timeout = timeout
+
+    async def test_mirror(self, mirror):
+        """Скорость загрузки PROBE_BYTES из Packages.gz в байтах/сек или None."""
+        bench = await self.benchmark_mirror(mirror, byte_budget=PROBE_BYTES, window=self.timeout)
+        if not bench:
+            return None
+        elapsed = self.app.bench_latency(bench) + bench["bytes"] / bench["throughput"]
+        return bench["bytes"] / elapsed if elapsed > 0 else None
+
+    async def probe_release(self, mirror):
+        bench = await self.benchmark_mirror(mirror, byte_budget=LATENCY_PROBE_BYTES,
+                                            path=RELEASE_FILE, keep_body=True)
+        return self.app.release_info(bench)
+
+    async def benchmark_mirror(self, mirror, byte_budget=BENCH_BYTES, window=BENCH_WINDOW,
+                               path=BENCH_FILE, keep_body=False):
+        import asyncio
+        url = f"{mirror.rstrip('/')}/{path}"
+        result = {"dns": 0.0, "connect": 0.0, "tls": 0.0, "ttfb": 0.0}
+        writer = None
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                if writer:
+                    writer.close()
+                status, headers, reader, writer = await self._timed_request(url, byte_budget, result)
+                if status not in (301, 302, 303, 307, 308):
+                    break
+                url = urljoin(url, headers.get("location", ""))
+            else:
+                return None
+            if status not in (200, 206):
+                return None
+
+            received = 0
+            body = []
+            start = time.perf_counter()
+            while received < byte_budget and time.perf_counter() - start < window:
+                chunk = await asyncio.wait_for(reader.read(min(65536, byte_budget - received)), self.timeout)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if keep_body:
+                    body.append(chunk)
+            elapsed = time.perf_counter() - start
+            if not received or elapsed <= 0:
+                return None
+            if keep_body:
+                result["body"] = b"".join(body)
+            result["bytes"] = received
+            result["throughput"] = received / elapsed
+            return result
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            return None
+        finally:
+            if writer:
+                writer.close()
+
+    async def _timed_request(self, url, byte_budget, timings):
+        """
+        GET по url (HTTP/1.0 — без chunked-кодирования), с замером фаз в timings.
+        Возвращает (статус, заголовки, reader, writer).
+        """
+        import asyncio
+        parts = urlsplit(url)
+        https = parts.scheme == "https"
+        host = parts.hostname
+        port = parts.port or (443 if https else 80)
+        loop = asyncio.get_running_loop()
+
+        t0 = time.perf_counter()
+        infos = await asyncio.wait_for(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), self.timeout)
+        t1 = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(infos[0][4][0], port), self.timeout)
+        try:
+            t2 = time.perf_counter()
+            if https:
+                await asyncio.wait_for(
+                    writer.start_tls(self.app.ssl_context(), server_hostname=host), self.timeout)
+            t3 = time.perf_counter()
+
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            writer.write((f"GET {path} HTTP/1.0\r\nHost: {parts.netloc}\r\n"
+                          f"User-Agent: kali-mirror-gui\r\nRange: bytes=0-{byte_budget - 1}\r\n\r\n").encode())
+            await writer.drain()
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+            t4 = time.perf_counter()
+        except BaseException:
+            writer.close()
+            raise
+
+        lines = head.decode("latin-1").split("\r\n")
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        timings["dns"] += t1 - t0
+        timings["connect"] += t2 - t1
+        timings["tls"] += t3 - t2
+        timings["ttfb"] += t4 - t3
+        return status, headers, reader, writer
+
+
+# === Ошибки apt-get update ===
+class AptErrorDetector:
+    """
+    Проверяет вывод apt-get update построчно, по мере поступления.
+    Все сигнатуры APT_ERROR_TAXONOMY собраны в одно регулярное выражение,
+    скомпилированное один раз; память не растёт с объёмом вывода.
+    """
+    _compiled = {}
+
+    def __init__(self, taxonomy=None):
+        taxonomy = tuple(taxonomy or APT_ERROR_TAXONOMY)
+        if taxonomy not in self._compiled:
+            pattern = "|".join(f"(?P<{kind}>{regex})" for kind, regex, _ in taxonomy)
+            self._compiled[taxonomy] = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+        self.regex = self._compiled[taxonomy]
+        self.fatal_kinds = {kind for kind, _, fatal in taxonomy if fatal}
+        self.counts = collections.Counter()
+        self.fatal = None  # (тип, строка) первой фатальной ошибки
+
+    def feed(self, line):
+        """Возвращает тип ошибки в строке line или None."""
+        match = self.regex.search(line)
+        if not match:
+            return None
+        kind = match.lastgroup
+        self.counts[kind] += 1
+        if kind in self.fatal_kinds and self.fatal is None:
+            self.fatal = (kind, line.strip())
+        return kind
+
+
+# === Прогресс apt (APT::Status-Fd) ===
+# kind: "download" (dlstatus), "install" (pmstatus), "error" (pmerror), "conffile" (pmconffile)
+AptProgress = collections.namedtuple("AptProgress", "kind package percent message")
+APT_STATUS_KINDS = {"dlstatus": "download", "pmstatus": "install", "pmerror": "error", "pmconffile": "conffile"}
+
+
+def parse_apt_status(line):
+    """
+    Разбирает строку APT::Status-Fd вида "pmstatus:libc6:amd64:42.5:Распаковка ..."
+    в AptProgress. Имя пакета может содержать ':', поэтому процентом считается
+    первое числовое поле после него. None для нераспознанных строк.
+    """
+    kind, _, rest = line.rstrip("\n").partition(":")
+    if kind not in APT_STATUS_KINDS:
+        return None
+    parts = rest.split(":")
+    for i in range(1, len(parts)):
+        try:
+            percent = float(parts[i])
+        except ValueError:
+            continue
+        return AptProgress(APT_STATUS_KINDS[kind], ":".join(parts[:i]), percent, ":".join(parts[i + 1:]))
+    return None
+
+
+# === Просмотр полного лога ===
+class LogPager:
+    """
+    Постраничное чтение лог-файла через mmap: в память попадает только
+    показываемая страница (около LOG_PAGE_BYTES), границы — по строкам.
+    """
+
+    def __init__(self, path, page_bytes=LOG_PAGE_BYTES):
+        self.path = path
+        self.page_bytes = page_bytes
+        self.mm = None
+        self.size = 0
+
+    def remap(self):
+        """Отображает файл заново — лог мог вырасти с прошлого раза."""
+        self.close()
+        with open(self.path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+
+    def _line_start(self, pos):
+        if pos <= 0:
+            return 0
+        return self.mm.rfind(b"\n", 0, pos) + 1
+
+    def page(self, start):
+        """Страница, начинающаяся со строки, в которой лежит байт start: (текст, начало, конец)."""
+        if not self.mm:
+            return "", 0, 0
+        start = self._line_start(min(max(0, start), self.size))
+        end = self.mm.find(b"\n", min(start + self.page_bytes, self.size))
+        end = self.size if end == -1 else end + 1
+        return self.mm[start:end].decode("utf-8", "replace"), start, end
+
+    def page_before(self, pos):
+        """Страница, заканчивающаяся перед байтом pos."""
+        return self.page(max(0, pos - self.page_bytes))
+
+    def last_page(self):
+        return self.page_before(self.size)
+
+
+# === Кэширующий прокси (--serve-cache) ===
+class CacheStore:
+    """
+    Контентно-адресуемое хранилище файлов на диске: blobs/<sha256>, плюс
+    индекс путь → sha256, размер и время последнего обращения. При
+    превышении max_bytes вытесняются давно не запрошенные файлы (LRU).
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or CACHE_DIR
+        self.max_bytes = max_bytes or CACHE_MAX_BYTES
+        self.index_path = os.path.join(self.root, "index.json")
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.index = {path: entry for path, entry in self.index.items()
+                      if os.path.exists(self.blob_path(entry["sha256"]))}
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    def open(self, path):
+        """
+        (открытый файл, размер) для закэшированного path или None. Файл
+        открывается под блокировкой: если его потом вытеснят, отдача не прервётся.
+        """
+        with self.lock:
+            entry = self.index.get(path)
+            if not entry:
+                return None
+            try:
+                src = open(self.blob_path(entry["sha256"]), "rb")
+            except FileNotFoundError:
+                del self.index[path]
+                return None
+            entry["atime"] = time.time()
+            return src, entry["size"]
+
+    def temp_path(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        os.close(fd)
+        return tmp
+
+    def add(self, path, tmp, sha256, size):
+        """Кладёт скачанный файл tmp в хранилище под именем path."""
+        blob = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        with self.lock:
+            if os.path.exists(blob):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, blob)
+            self.index[path] = {"sha256": sha256, "size": size, "atime": time.time()}
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        # Один blob может отвечать нескольким путям — вытесняем целиком
+        blobs = {}
+        for path, entry in self.index.items():
+            blob = blobs.setdefault(entry["sha256"], {"atime": 0, "size": entry["size"], "paths": []})
+            blob["atime"] = max(blob["atime"], entry["atime"])
+            blob["paths"].append(path)
+        total = sum(blob["size"] for blob in blobs.values())
+        for sha256, blob in sorted(blobs.items(), key=lambda item: item[1]["atime"]):
+            if total <= self.max_bytes:
+                break
+            for path in blob["paths"]:
+                del self.index[path]
+            try:
+                os.remove(self.blob_path(sha256))
+            except FileNotFoundError:
+                pass
+            total -= blob["size"]
+
+    def _save(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+
+class CachingProxy:
+    """
+    HTTP-прокси для apt: клиенты указывают его вместо зеркала
+    (deb http://<хост>:3142/ kali-rolling ...). .deb и индексы by-hash
+    кэшируются в CacheStore; одновременные промахи по одному файлу
+    сливаются в одну загрузку с зеркала. Остальное (InRelease и т.п.)
+    проксируется без кэширования.
+    """
+
+    def __init__(self, app, store, upstreams):
+        self.app = app
+        self.store = store
+        self.upstreams = upstreams
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+
+    def cacheable(self, path):
+        return path.endswith((".deb", ".udeb")) or "/by-hash/SHA256/" in path
+
+    def open_upstream(self, path, headers=None):
+        """Ответ первого зеркала, у которого есть path (200/304), или последний полученный."""
+        import requests
+        resp = None
+        for mirror in self.upstreams:
+            if resp is not None:
+                resp.close()
+            try:
+                resp = self.app.session.get(f"{mirror.rstrip('/')}{path}", headers=headers or {},
+                                            stream=True, timeout=30)
+            except requests.RequestException:
+                resp = None
+                continue
+            if resp.status_code in (200, 304):
+                return resp
+        return resp
+
+    def handler_class(self):
+        from http.server import BaseHTTPRequestHandler
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, fmt, *args):
+                logging.info("proxy %s - %s", self.address_string(), fmt % args)
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                if proxy.cacheable(path):
+                    proxy.serve_cached(self, path)
+                else:
+                    proxy.pass_through(self, path)
+
+        return Handler
+
+    def pass_through(self, client, path):
+        headers = {}
+        if client.headers.get("If-Modified-Since"):
+            headers["If-Modified-Since"] = client.headers["If-Modified-Since"]
+        resp = self.open_upstream(path, headers)
+        if resp is None:
+            client.send_error(502)
+            return
+        with resp:
+            client.send_response(resp.status_code)
+            for name in ("Content-Length", "Last-Modified", "Content-Type", "ETag"):
+                if name in resp.headers:
+                    client.send_header(name, resp.headers[name])
+            if "Content-Length" not in resp.headers and resp.status_code != 304:
+                client.send_header("Connection", "close")
+                client.close_connection = True
+            client.end_headers()
+            if resp.status_code != 304:
+                for chunk in resp.raw.stream(65536, decode_content=False):
+                    client.wfile.write(chunk)
+
+    def serve_cached(self, client, path):
+        hit = self.store.open(path)
+        fill = src = None
+        if not hit:
+            with self.inflight_lock:
+                fill = self.inflight.get(path)
+                if fill:
+                    # Открываем, пока загрузка учтена в inflight: до переноса tmp в хранилище
+                    src = open(fill["tmp"], "rb")
+                else:
+                    # Пока ждали блокировку, файл мог докачаться
+                    hit = self.store.open(path)
+                    if not hit:
+                        fill = {"tmp": self.store.temp_path(), "status": None, "size": None,
+                                "ok": False, "started": threading.Event(), "done": threading.Event()}
+                        self.inflight[path] = fill
+        if hit:
+            self.send_file(client, *hit)
+        elif src:
+            with src:
+                self.follow(client, fill, src)
+        else:
+            try:
+                self.fill(client, path, fill)
+            finally:
+                with self.inflight_lock:
+                    # Перенос в хранилище и снятие с учёта — одним шагом для serve_cached
+                    try:
+                        if fill["ok"]:
+                            self.store.add(path, fill["tmp"], fill["sha256"], fill["bytes"])
+                    except OSError as e:
+                        fill["ok"] = False
+                        logging.warning("proxy: не удалось сохранить %s в кэш: %s", path, e)
+                    finally:
+                        del self.inflight[path]
+                if not fill["ok"] and os.path.exists(fill["tmp"]):
+                    os.remove(fill["tmp"])
+                fill["started"].set()
+                fill["done"].set()
+
+    def fill(self, client, path, fill):
+        """Качает path с зеркала в хранилище, одновременно отдавая первому клиенту."""
+        resp = self.open_upstream(path)
+        fill["status"] = resp.status_code if resp is not None else 502
+        if fill["status"] != 200:
+            client.send_error(fill["status"])
+            if resp is not None:
+                resp.close()
+            return
+        digest = hashlib.sha256()
+        size = 0
+        with resp, open(fill["tmp"], "wb") as out:
+            fill["size"] = resp.headers.get("Content-Length")
+            fill["started"].set()
+            client_ok = self.start_reply(client, fill["size"])
+            for chunk in resp.raw.stream(65536, decode_content=False):
+                out.write(chunk)
+                out.flush()
+                digest.update(chunk)
+                size += len(chunk)
+                if client_ok:
+                    try:
+                        client.wfile.write(chunk)
+                    except OSError:
+                        # Клиент ушёл — файл всё равно докачиваем для остальных
+                        client_ok = False
+        sha256 = digest.hexdigest()
+        complete = fill["size"] is None or int(fill["size"]) == size
+        expected = path.rsplit("/", 1)[-1] if "/by-hash/SHA256/" in path else sha256
+        if complete and expected == sha256:
+            # В хранилище файл переносит serve_cached
+            fill.update(ok=True, sha256=sha256, bytes=size)
+
+    def follow(self, client, fill, src):
+        """Отдаёт из src файл, который сейчас качает другой запрос, по мере его роста."""
+        fill["started"].wait()
+        if fill["status"] != 200:
+            client.send_error(fill["status"] or 502)
+            return
+        if not self.start_reply(client, fill["size"]):
+            return
+        try:
+            while True:
+                # done проверяем до чтения: иначе последний кусок можно потерять
+                finished = fill["done"].is_set()
+                chunk = src.read(65536)
+                if chunk:
+                    client.wfile.write(chunk)
+                elif finished:
+                    break
+                else:
+                    time.sleep(0.05)
+        except OSError:
+            # Клиент ушёл
+            pass
+
+    def start_reply(self, client, size):
+        try:
+            client.send_response(200)
+            client.send_header("Content-Type", "application/octet-stream")
+            if size is not None:
+                client.send_header("Content-Length", str(size))
+            else:
+                client.send_header("Connection", "close")
+                client.close_connection = True
+            client.end_headers()
+            return True
+        except OSError:
+            return False
+
+    def send_file(self, client, src, size):
+        with src:
+            if self.start_reply(client, size):
+                shutil.copyfileobj(src, client.wfile, 1 << 20)
+
 
 class MirrorApp:
-    def __init__(self, root):
+    def __init__(self, root, require_root=True):
+        setup_logging()
         self.root = root
-        self.root.title("Kali Mirror Updater ✨")
-        self.root.geometry("600x500")
-        self.root.resizable(True, True)
+        # Без окна (CLI, --serve-cache) — вывод только в терминал и лог-файл
+        self.gui = GUI_AVAILABLE and root is not None
+        if self.gui:
+            self.root.title("Kali Mirror Updater ✨")
+            self.root.geometry("600x500")
+            self.root.resizable(True, True)
+        # Строки для окна лога; разбирает flush_log в главном потоке Tk
+        self.log_queue = queue.SimpleQueue()
+        # Вызовы Tk из рабочего потока (диалоги, кнопки) — их тоже выполняет flush_log
+        self.ui_calls = queue.SimpleQueue()
+        # Строк текста в окне лога (сообщение с \n занимает несколько)
+        self.console_widget_lines = 0
+        # Последнее событие прогресса apt и время начала команды; показывает flush_log
+        self.apt_progress = None
+        self.shown_progress = None
 
-        if os.geteuid() != 0:
-            if GUI_AVAILABLE:
+        if require_root and os.geteuid() != 0:
+            if self.gui:
                 messagebox.showerror("Ошибка", "Запустите с sudo!")
             else:
                 print("Ошибка: запустите с sudo!")
@@ -61,9 +971,29 @@ class MirrorApp:
         self.process_running = False
         self.cancel_event = threading.Event()
         self.current_process = None
+        # Session (и с ним requests) создаётся при первом HTTP-запросе
+        self._session = None
+        self._session_lock = threading.Lock()
+        # Замеры зеркал идут мимо requests (см. ProbeClient)
+        self.probe_client = ProbeClient(self.ssl_context)
+        # Фоновая служба проверяет зеркала медленнее (см. run_daemon)
+        self.probe_workers = None
+        self.probe_deadline = PROBE_DEADLINE
+        # Оценка потолка нашего канала, байт/с (наибольшая суммарная скорость группы замеров)
+        self.link_ceiling = 0.0
+        # Скорость зеркал, замеренных в одиночку, байт/с — для проверки групп замеров
+        self.solo_rates = {}
+        # Последний рейтинг (балл, зеркало) — из него строится MIRROR_LIST_FILE
+        self.ranking = []
+        # Раскладка компонентов по зеркалам в режиме "sharded": [(зеркало, [компоненты])]
+        self.shards = []
+        # Быстрая установка и замер её времени (см. report_install_time)
+        self.fast_install = FAST_INSTALL
+        self.install_report = None
+        self.install_started = None
 
         # UI
-        if GUI_AVAILABLE:
+        if self.gui:
             self.text_box = tk.Text(self.root, wrap="word", height=22, width=80, state='disabled', font=("Monospace", 9))
             self.text_box.pack(pady=10, padx=10)
 
@@ -79,8 +1009,18 @@ class MirrorApp:
             self.cancel_button = ttk.Button(self.btn_frame, text="❌ Отмена", command=self.cancel_process, state='disabled')
             self.cancel_button.pack(side="left", padx=5)
 
+            self.full_log_btn = ttk.Button(self.btn_frame, text="📜 Полный лог", command=self.show_full_log)
+            self.full_log_btn.pack(side="left", padx=5)
+
+            self.fast_install_var = tk.BooleanVar(value=FAST_INSTALL)
+            self.fast_install_chk = ttk.Checkbutton(self.root, text="⚡ Быстрая установка (dpkg unsafe-io)",
+                                                    variable=self.fast_install_var)
+            self.fast_install_chk.pack()
+
             self.progress = ttk.Progressbar(self.root, orient="horizontal", length=560, mode="indeterminate")
             self.progress.pack(pady=5)
+            self.progress_label = ttk.Label(self.root, text="")
+            self.progress_label.pack()
 
             # Тема
             try:
@@ -89,14 +1029,122 @@ class MirrorApp:
             except Exception as e:
                 self.log(f"[!] Не удалось загрузить sv_ttk: {e}")
 
+            self.root.after(LOG_FLUSH_MS, self.flush_log)
+
     def log(self, msg):
-        print(msg)
-        if GUI_AVAILABLE:
+        """Можно вызывать из любого потока: виджет обновляет только flush_log."""
+        if self.gui:
+            self.log_queue.put(msg)
+        else:
+            print(msg)
+        logging.info(msg)
+
+    def flush_log(self):
+        """Переносит накопленные строки лога в окно пачкой и планирует следующий проход."""
+        lines = []
+        try:
+            while len(lines) < LOG_MAX_LINES_PER_TICK:
+                lines.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if lines:
+            text = "\n".join(lines) + "\n"
+            print(text, end="")
             self.text_box.config(state='normal')
-            self.text_box.insert(tk.END, msg + "\n")
+            self.text_box.insert(tk.END, text)
+            self.console_widget_lines += text.count("\n")
+            if self.console_widget_lines >= CONSOLE_MAX_LINES + CONSOLE_TRIM_CHUNK:
+                extra = self.console_widget_lines - CONSOLE_MAX_LINES
+                self.text_box.delete("1.0", f"{extra + 1}.0")
+                self.console_widget_lines = CONSOLE_MAX_LINES
             self.text_box.config(state='disabled')
             self.text_box.see(tk.END)
-        logging.info(msg)
+        self.show_progress()
+        # После строк лога: итоговый диалог не должен опережать последние строки
+        while True:
+            try:
+                fn, args = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            fn(*args)
+        self.root.after(LOG_FLUSH_MS, self.flush_log)
+
+    def in_ui(self, fn, *args):
+        """Выполнить fn(*args) в главном потоке Tk (из любого потока)."""
+        self.ui_calls.put((fn, args))
+
+    def show_progress(self):
+        """Переводит полосу прогресса в проценты по событиям apt (или обратно в «бегущую»)."""
+        state = self.apt_progress
+        if state is self.shown_progress:
+            return
+        self.shown_progress = state
+        if state is None:
+            self.progress_label.config(text="")
+            if str(self.progress.cget("mode")) != "indeterminate":
+                self.progress.config(mode="indeterminate", value=0)
+                if self.process_running:
+                    self.progress.start()
+            return
+        event, started = state
+        if str(self.progress.cget("mode")) != "determinate":
+            self.progress.stop()
+            self.progress.config(mode="determinate", maximum=100)
+        self.progress.config(value=event.percent)
+        phase = {"download": "Загрузка", "install": "Установка"}.get(event.kind, event.kind)
+        text = f"{phase}: {event.percent:.0f}%"
+        if 0 < event.percent < 100:
+            eta = (time.monotonic() - started) * (100 - event.percent) / event.percent
+            text += f", осталось ~{eta / 60:.0f} мин" if eta >= 90 else f", осталось ~{eta:.0f} с"
+        if event.kind == "install" and event.package:
+            text += f" — {event.package}"
+        self.progress_label.config(text=text)
+
+    def show_full_log(self):
+        """Окно просмотра всего LOG_FILE по страницам (LogPager)."""
+        pager = LogPager(LOG_FILE)
+        win = tk.Toplevel(self.root)
+        win.title("Полный лог")
+        win.geometry("800x600")
+
+        nav = tk.Frame(win)
+        nav.pack(side="bottom", fill="x", pady=5)
+        status = ttk.Label(nav)
+        text = tk.Text(win, wrap="none", state='disabled', font=("Monospace", 9))
+        scroll = ttk.Scrollbar(win, command=text.yview)
+        text.config(yscrollcommand=scroll.set)
+        scroll.pack(side="right", fill="y")
+        text.pack(side="left", fill="both", expand=True)
+        shown = {"start": 0, "end": 0}
+
+        def show(page, at_end=False):
+            content, shown["start"], shown["end"] = page
+            text.config(state='normal')
+            text.delete("1.0", tk.END)
+            text.insert(tk.END, content)
+            text.config(state='disabled')
+            text.see(tk.END if at_end else "1.0")
+            status.config(text=f"{shown['start'] // 1024}–{shown['end'] // 1024} КБ из {pager.size // 1024} КБ")
+
+        def last():
+            try:
+                pager.remap()
+            except OSError as e:
+                status.config(text=f"Не удалось открыть {LOG_FILE}: {e}")
+                return
+            show(pager.last_page(), at_end=True)
+
+        def close():
+            pager.close()
+            win.destroy()
+
+        ttk.Button(nav, text="⏮ Начало", command=lambda: show(pager.page(0))).pack(side="left", padx=5)
+        ttk.Button(nav, text="◀", command=lambda: show(pager.page_before(shown["start"]), at_end=True)).pack(side="left", padx=5)
+        ttk.Button(nav, text="▶", command=lambda: show(pager.page(shown["end"]))).pack(side="left", padx=5)
+        ttk.Button(nav, text="⏭ Конец", command=last).pack(side="left", padx=5)
+        status.pack(side="left", padx=10)
+        win.protocol("WM_DELETE_WINDOW", close)
+        last()
 
     def is_kali(self):
         try:
@@ -139,7 +1187,7 @@ class MirrorApp:
         return True
 
     def add_custom_mirror(self):
-        if not GUI_AVAILABLE:
+        if not self.gui:
             url = input("Введите URL зеркала (например, https://mirror.example.com/kali): ")
             if self.save_custom_mirror(url):
                 self.log(f"[+] Добавлено пользовательское зеркало: {url}")
@@ -153,9 +1201,31 @@ class MirrorApp:
             else:
                 messagebox.showerror("Ошибка", "Некорректный URL.")
 
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                self._session = self.make_session()
+            return self._session
+
+    def make_session(self):
+        """
+        Общий Session для всех запросов к зеркалам. Пул рассчитан на
+        PROBE_CONCURRENCY одновременных проверок одного хоста, поэтому
+        повторная проверка не платит заново за TCP- и TLS-рукопожатие.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=PROBE_CONCURRENCY)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["User-Agent"] = "kali-mirror-gui"
+        return session
+
     def has_internet(self):
         try:
-            requests.get("https://1.1.1.1", timeout=3)
+            self.session.head("https://1.1.1.1", timeout=3)
             return True
         except:
             return False
@@ -165,13 +1235,14 @@ class MirrorApp:
             return
         if not self.has_internet():
             msg = "Проверьте подключение к интернету."
-            if GUI_AVAILABLE:
+            if self.gui:
                 messagebox.showerror("Нет интернета", msg)
             else:
                 print("❌ " + msg)
             return
         self.cancel_event.clear()
-        if GUI_AVAILABLE:
+        if self.gui:
+            self.fast_install = self.fast_install_var.get()
             self.run_button.config(state='disabled')
             self.add_mirror_btn.config(state='disabled')
             self.cancel_button.config(state='normal')
@@ -183,35 +1254,55 @@ class MirrorApp:
     def cancel_process(self):
         self.log("[!] Отмена...")
         self.cancel_event.set()
-        if self.current_process:
-            try:
-                self.current_process.terminate()
-                self.current_process.wait(timeout=3)
-            except:
-                pass
+        proc = self.current_process
+        if proc:
+            # Не ждём завершения: окно не должно зависать
+            self.stop_process(proc)
+
+    def stop_process(self, proc):
+        """
+        SIGTERM всей группе процессов proc (apt вместе с dpkg и методами
+        загрузки), через PROCESS_KILL_GRACE секунд — SIGKILL. Не блокирует.
+        """
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            return
+
+        def kill():
+            if proc.poll() is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+
+        timer = threading.Timer(PROCESS_KILL_GRACE, kill)
+        timer.daemon = True
+        timer.start()
 
     def full_update_process(self):
+        run_lock = None
         try:
+            run_lock = self.acquire_run_lock(wait=True)
+            if run_lock is None:
+                return
             mirrors = self.load_mirrors()
-            self.log(f"[+] Проверка {len(mirrors)} зеркал...")
-
-            # Тестируем зеркала по скорости загрузки Packages.gz
-            results = []
-            for mirror in mirrors:
-                if self.cancel_event.is_set():
-                    return
-                score = self.test_mirror(mirror)
-                if score:
-                    results.append((score, mirror))
-                    self.log(f"    ✅ {mirror} — {score:.2f} байт/с")
-                else:
-                    self.log(f"    ❌ {mirror} — не отвечает")
+            scores = ScoreCache()
+            ranked_at = self.load_daemon_state().get("ranked_at", 0)
+            if time.time() - ranked_at < SCORE_TTL:
+                # Фоновая служба держит рейтинг свежим — сеть не трогаем
+                self.log(f"[+] Рейтинг фоновой службы ({int(time.time() - ranked_at) // 60} мин назад), "
+                         "проверка зеркал пропущена")
+                results = scores.ranking(mirrors)
+            else:
+                results = self.rank_mirrors(mirrors, scores)
+            if self.cancel_event.is_set():
+                return
 
             if not results:
                 raise Exception("Ни одно зеркало не прошло тест.")
 
-            # Сортируем по скорости (чем выше — тем лучше)
-            results.sort(key=lambda x: x[0], reverse=True)
+            self.ranking = results
             ranked_mirrors = [mirror for _, mirror in results]
 
             # Создаём бэкап sources.list один раз
@@ -220,55 +1311,460 @@ class MirrorApp:
                 shutil.copy2("/etc/apt/sources.list", bak)
                 self.log(f"[+] Создан бэкап: {bak}")
 
-            # Пробуем зеркала по одному, пока не найдём рабочее
-            working_mirror = None
-            for mirror in ranked_mirrors:
+            # Сначала лучшие зеркала — параллельно, каждое в своём каталоге apt
+            working_mirror = self.validate_mirrors(ranked_mirrors[:VALIDATE_TOP_N], scores)
+            if self.cancel_event.is_set():
+                return
+
+            # Остальные пробуем по одному, пока не найдём рабочее
+            for mirror in ranked_mirrors[VALIDATE_TOP_N:]:
+                if working_mirror:
+                    break
                 if self.cancel_event.is_set():
                     return
                 self.log(f"[→] Пробую зеркало: {mirror}")
-                self.set_sources_list(mirror)
+                source = self.current_sources_uri()
+                with self.apt_lock():
+                    if source:
+                        self.transplant_lists(source, mirror, APT_LISTS_DIR, new_uri=self.sources_uri(mirror))
+                    self.set_sources_list(mirror)
                 try:
                     self.run_cmd("apt-get update -y", check_apt_update=True)
                     working_mirror = mirror
-                    break
                 except Exception as e:
+                    # Отмена — не вина зеркала: оценку в кэше не портим
+                    if self.cancel_event.is_set():
+                        return
                     self.log(f"[!] Зеркало не подошло: {e}")
+                    scores.record_failure(mirror)
+                    scores.save()
 
             if not working_mirror:
                 raise Exception("Ни одно зеркало не работает стабильно.")
 
+            # Сравниваем лучшие зеркала на пакетах, которые сейчас предстоит скачать, —
+            # по только что полученным индексам: до apt-get update список был бы устаревшим
+            forecasts = {}
+            if WORKLOAD_SELECTION:
+                files = self.pending_downloads([working_mirror])
+                if files:
+                    candidates = [working_mirror] + [m for m in ranked_mirrors if m != working_mirror]
+                    ranked_mirrors, forecasts = self.rank_for_workload(candidates, files)
+                if self.cancel_event.is_set():
+                    return
+                best = ranked_mirrors[0]
+                if best != working_mirror and best in forecasts and SOURCES_MODE == "mirrorlist":
+                    # Индексы записаны под URI списка зеркал — достаточно поставить best первым
+                    with self.apt_lock():
+                        self.write_mirror_list(best)
+                    self.log(f"[+] Под это обновление быстрее {best}")
+                    working_mirror = best
+
             self.log(f"[+] Используем: {working_mirror}")
+            if working_mirror in forecasts:
+                eta = forecasts[working_mirror]["eta"]
+                self.log(f"[+] Прогноз загрузки пакетов: ~{eta / 60:.0f} мин" if eta >= 90
+                         else f"[+] Прогноз загрузки пакетов: ~{eta:.0f} с")
+
+            # Пакеты заранее качаем параллельно с нескольких лучших зеркал
+            if PARALLEL_DOWNLOAD:
+                others = [mirror for mirror in ranked_mirrors if mirror != working_mirror]
+                try:
+                    self.prefetch_upgrade([working_mirror] + others[:DOWNLOAD_MIRRORS - 1])
+                except Exception as e:
+                    self.log(f"[!] Предзагрузка не удалась, apt скачает пакеты сам: {e}")
+                if self.cancel_event.is_set():
+                    return
 
             # Продолжаем обновление
-            self.run_cmd("apt-get upgrade -y")
+            fast = self.fast_install and self.fast_install_supported()
+            self.install_report = {"seconds": 0.0, "packages": set()}
+            self.run_cmd("apt-get upgrade -y", fast=fast)
             if self.cancel_event.is_set(): return
 
-            self.run_cmd("apt-get install -f -y")
+            self.run_cmd("apt-get install -f -y", fast=fast)
             if self.cancel_event.is_set(): return
+            if fast:
+                # Всё, что dpkg не сбросил на диск сам, — одним sync
+                started = time.monotonic()
+                self.run_cmd("sync")
+                self.install_report["seconds"] += time.monotonic() - started
+            self.report_install_time(fast)
 
             self.run_cmd("apt-get autoremove -y")
             self.run_cmd("apt-get autoclean -y")
             self.run_cmd("apt-get clean -y")
 
             self.log("[✅] Готово!")
-            if GUI_AVAILABLE:
-                messagebox.showinfo("Успех", "Система обновлена и очищена!")
+            if self.gui:
+                self.in_ui(messagebox.showinfo, "Успех", "Система обновлена и очищена!")
             else:
                 print("✅ Система обновлена и очищена!")
         except Exception as e:
             err = str(e)
             self.log(f"[!] Ошибка: {err}")
-            if GUI_AVAILABLE:
-                messagebox.showerror("Ошибка", err)
+            if self.gui:
+                self.in_ui(messagebox.showerror, "Ошибка", err)
             else:
                 print(f"❌ Ошибка: {err}")
         finally:
-            if GUI_AVAILABLE:
-                self.progress.stop()
-                self.process_running = False
-                self.run_button.config(state='normal')
-                self.add_mirror_btn.config(state='normal')
-                self.cancel_button.config(state='disabled')
+            if run_lock is not None:
+                os.close(run_lock)
+            if self.gui:
+                self.in_ui(self.process_finished)
+
+    def process_finished(self):
+        """Возвращает кнопки и полосу прогресса в исходное состояние (главный поток Tk)."""
+        self.progress.stop()
+        self.process_running = False
+        self.run_button.config(state='normal')
+        self.add_mirror_btn.config(state='normal')
+        self.cancel_button.config(state='disabled')
+
+    def rank_mirrors(self, mirrors, scores, refresh=False):
+        """
+        Возвращает список (балл, зеркало) от лучшего к худшему.
+        Зеркала со свежей оценкой в кэше scores не проверяются заново
+        (если не задан refresh), остальные проверяются по сети, и кэш
+        обновляется.
+        """
+        cached = [mirror for mirror in mirrors if scores.is_fresh(mirror) and not refresh]
+        stale = [mirror for mirror in mirrors if mirror not in cached]
+        results = [(scores.score(mirror), mirror) for mirror in cached]
+        if cached:
+            self.log(f"[+] Из кэша: {len(cached)} зеркал")
+
+        if stale:
+            self.log(f"[+] Проверка {len(stale)} зеркал...")
+            # Тестируем зеркала по скорости загрузки Packages.gz (параллельно)
+            eliminated = []
+            try:
+                if BENCHMARK_MODE:
+                    probed, eliminated = self.tournament(stale)
+                    for bench, mirror in probed:
+                        scores.record(mirror, self.score_benchmark(bench), bench["throughput"],
+                                      self.bench_latency(bench))
+                else:
+                    # Свежесть InRelease проверяем и здесь: устаревшее зеркало не должно выиграть по скорости
+                    released = self.probe_mirrors(stale, probe=self.probe_fn("probe_release"),
+                                                  describe=self.describe_release,
+                                                  workers=self.probe_workers or LATENCY_PROBE_CONCURRENCY)
+                    fresh, outdated = self.check_freshness(released)
+                    if FRESHNESS_POLICY == "penalize":
+                        eliminated = outdated
+                    probed = []
+                    if not self.cancel_event.is_set():
+                        probed = self.probe_mirrors([mirror for _, mirror in fresh],
+                                                    probe=self.probe_fn("test_mirror"))
+                    for speed, mirror in probed:
+                        scores.record(mirror, speed, throughput=speed)
+            finally:
+                # Свободные соединения проверок после отбора не нужны
+                self.probe_client.close()
+            if self.cancel_event.is_set():
+                return results
+            answered = {mirror for _, mirror in probed + eliminated}
+            for mirror in stale:
+                if mirror not in answered:
+                    scores.record_failure(mirror)
+            scores.save()
+            results += [(scores.score(mirror), mirror) for _, mirror in probed]
+            results.sort(key=lambda x: x[0], reverse=True)
+            # Выбывшие в отборе идут в конец списка, в порядке своих раундов
+            results += [(0.0, mirror) for _, mirror in eliminated]
+            return results
+
+        # Сортируем по баллу (чем выше — тем лучше)
+        results.sort(key=lambda x: x[0], reverse=True)
+        return results
+
+    def tournament(self, mirrors):
+        """
+        Отбор зеркал по турнирной схеме. Первый раунд скачивает только начало
+        InRelease у всех зеркал: меряет задержку и отсеивает устаревшие зеркала
+        (check_freshness). Каждый следующий раунд оставляет долю TOURNAMENT_KEEP
+        лучших и увеличивает объём замера; финалисты получают полный замер
+        BENCH_BYTES. Возвращает (финалисты, выбывшие) — списки (замер, зеркало),
+        финалисты без сортировки, выбывшие от лучших к худшим.
+        """
+        rounds = max(2, TOURNAMENT_ROUNDS)
+        self.log(f"[+] Раунд 1: {len(mirrors)} зеркал, задержка и свежесть InRelease")
+        probed = self.probe_mirrors(mirrors, probe=self.probe_fn("probe_release"),
+                                    describe=self.describe_release,
+                                    workers=self.probe_workers or LATENCY_PROBE_CONCURRENCY)
+        spent = sum(bench["bytes"] for bench, _ in probed)
+        if self.cancel_event.is_set():
+            return [], []
+        probed, outdated = self.check_freshness(probed)
+        probed.sort(key=lambda x: self.bench_latency(x[0]))
+        # Устаревшие зеркала в замерах скорости не участвуют
+        eliminated = outdated if FRESHNESS_POLICY == "penalize" else []
+        field = [mirror for _, mirror in probed]
+
+        for rnd in range(1, rounds):
+            if not field:
+                break
+            # Перед каждым раундом, и перед финальным тоже, — отсев по итогам предыдущего
+            keep = max(TOURNAMENT_MIN_KEEP, math.ceil(len(probed) * TOURNAMENT_KEEP))
+            # Проигравшие позднее стоят выше проигравших раньше
+            eliminated = probed[keep:] + eliminated
+            field = [mirror for _, mirror in probed[:keep]]
+            final = rnd == rounds - 1 or len(field) <= TOURNAMENT_MIN_KEEP
+            if final:
+                budget = BENCH_BYTES
+            else:
+                budget = max(LATENCY_PROBE_BYTES, int(BENCH_BYTES * TOURNAMENT_KEEP ** (rounds - 1 - rnd)))
+            self.log(f"[+] Раунд {rnd + 1}: {len(field)} зеркал, до {budget // 1024} КБ на зеркало")
+
+            probed = self.probe_bandwidth(
+                field,
+                probe=functools.partial(self.probe_fn("benchmark_mirror"), byte_budget=budget),
+                describe=self.describe_benchmark)
+            spent += sum(bench["bytes"] for bench, _ in probed)
+            if final or self.cancel_event.is_set():
+                break
+            probed.sort(key=lambda x: self.score_benchmark(x[0]), reverse=True)
+
+        self.log(f"[+] На отбор потрачено {spent // 1024} КБ")
+        return probed, eliminated
+
+    def probe_release(self, mirror):
+        """
+        Скачивает начало InRelease зеркала: замер задержки плюс поля
+        Date и Valid-Until (в секундах epoch). None при ошибке.
+        """
+        # Соединение пригодится test_mirror в быстром режиме
+        bench = self.benchmark_mirror(mirror, byte_budget=LATENCY_PROBE_BYTES,
+                                      path=RELEASE_FILE, keep_body=True, reuse=True)
+        return self.release_info(bench)
+
+    def release_info(self, bench):
+        """Добавляет в замер bench поля Date и Valid-Until из скачанного InRelease."""
+        from email.utils import parsedate_to_datetime
+        if not bench:
+            return None
+        fields = self.parse_release(bench.pop("body").decode("utf-8", "replace"))
+        try:
+            bench["date"] = parsedate_to_datetime(fields["Date"]).timestamp()
+            until = fields.get("Valid-Until")
+            bench["valid_until"] = parsedate_to_datetime(until).timestamp() if until else None
+        except (KeyError, TypeError, ValueError):
+            return None
+        return bench
+
+    def parse_release(self, text):
+        """Поля заголовка Release/InRelease (Date, Valid-Until, ...) в виде dict."""
+        fields = {}
+        for line in text.splitlines():
+            if line.startswith("-----BEGIN PGP SIGNATURE"):
+                break
+            if not line or line[0].isspace() or ":" not in line:
+                continue
+            key, _, value = line.partition(":")
+            fields[key] = value.strip()
+        return fields
+
+    def check_freshness(self, probed):
+        """
+        Делит результаты probe_release на свежие и устаревшие: отстающие от
+        самого нового зеркала больше FRESHNESS_MAX_LAG или с истёкшим Valid-Until.
+        """
+        if not probed:
+            return [], []
+        newest = max(bench["date"] for bench, _ in probed)
+        now = time.time()
+        fresh, outdated = [], []
+        for bench, mirror in probed:
+            lag = newest - bench["date"]
+            expired = bench["valid_until"] is not None and bench["valid_until"] < now
+            if expired or lag > FRESHNESS_MAX_LAG:
+                reason = "Valid-Until истёк" if expired else f"отстаёт на {lag / 3600:.1f} ч"
+                self.log(f"    🕒 {mirror} — устарело: {reason}")
+                outdated.append((bench, mirror))
+            else:
+                fresh.append((bench, mirror))
+        return fresh, outdated
+
+    def describe_release(self, bench):
+        age = (time.time() - bench["date"]) / 3600
+        return f"задержка {self.bench_latency(bench) * 1000:.0f} мс, InRelease от {age:.1f} ч назад"
+
+    def bench_latency(self, bench):
+        """Суммарная задержка замера до первого байта, сек."""
+        return bench["dns"] + bench["connect"] + bench["tls"] + bench["ttfb"]
+
+    def probe_fn(self, name):
+        """Проверка name (test_mirror, benchmark_mirror, probe_release) для PROBE_BACKEND."""
+        if PROBE_BACKEND == "asyncio":
+            if not getattr(self, "async_prober", None):
+                self.async_prober = AsyncProber(self)
+            return getattr(self.async_prober, name)
+        return getattr(self, name)
+
+    def probe_mirrors(self, mirrors, probe=None, describe=None, workers=None, deadline=None):
+        """
+        Проверяет зеркала параллельно (не больше workers одновременно).
+        probe — функция или корутина (AsyncProber); корутины выполняются
+        в одном цикле событий asyncio. Результаты пишутся в лог по мере
+        готовности; всё, что не успело за deadline секунд или после отмены,
+        считается не ответившим.
+        Возвращает список (результат probe, зеркало) для ответивших зеркал.
+        """
+        probe = probe or self.test_mirror
+        describe = describe or (lambda score: f"{score:.2f} байт/с")
+        workers = workers or self.probe_workers
+        deadline = deadline or self.probe_deadline
+        results = []
+        if not mirrors:
+            return results
+        if PROBE_BACKEND == "asyncio":
+            import asyncio
+            if asyncio.iscoroutinefunction(probe):
+                asyncio.run(self._probe_mirrors_async(mirrors, probe, describe,
+                                                      workers or ASYNC_PROBE_LIMIT, deadline, results))
+                return results
+
+        workers = workers or PROBE_CONCURRENCY
+        pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(mirrors))))
+        futures = {pool.submit(probe, mirror): mirror for mirror in mirrors}
+        pending = set(futures)
+        end = time.monotonic() + deadline
+        try:
+            while pending and not self.cancel_event.is_set():
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Короткий wait, чтобы быстро реагировать на cancel_event
+                done, pending = wait(pending, timeout=min(0.2, remaining), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    self._report_probe(results, futures[fut], fut, describe)
+            if not self.cancel_event.is_set():
+                for fut in pending:
+                    self.log(f"    ⌛ {futures[fut]} — не уложилось в {deadline} с")
+        finally:
+            # Не ждём зависшие проверки: они завершатся сами по своему таймауту
+            pool.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def probe_bandwidth(self, mirrors, probe, describe):
+        """
+        Замеры скорости (probe возвращает dict с "throughput") небольшими
+        группами по очереди: одновременные загрузки делят наш канал, и замер
+        показывал бы канал, а не зеркала. Группа растёт до BANDWIDTH_GROUP,
+        пока канал свободен. Если группа вместе дала примерно потолок
+        self.link_ceiling, не превысив его, или зеркало в ней просело против
+        своего одиночного замера (self.solo_rates), группа упёрлась в канал:
+        её самые быстрые зеркала замеряются заново по одному. Так же в конце —
+        для групп, упёршихся в потолок, который стал известен уже после них.
+        Замеры, где зеркало одно заняло почти весь канал, помечаются
+        "saturated" (см. effective_throughput).
+        Возвращает то же, что probe_mirrors.
+        """
+        limit = min(BANDWIDTH_GROUP, self.probe_workers or BANDWIDTH_GROUP)
+        size = 1
+        groups = []
+        rechecked = False
+        waiting = list(mirrors)
+        while waiting and not self.cancel_event.is_set():
+            group, waiting = waiting[:size], waiting[size:]
+            probed = self.probe_mirrors(group, probe=probe, describe=describe, workers=size)
+            total = sum(bench["throughput"] for bench, _ in probed)
+            dropped = any(bench["throughput"] < LINK_SATURATION * self.solo_rates[mirror]
+                          for bench, mirror in probed if mirror in self.solo_rates)
+            for bench, mirror in probed:
+                bench["group"] = len(group)
+                if len(group) == 1:
+                    self.solo_rates[mirror] = bench["throughput"]
+            # Зеркал больше, а вместе они дали столько же, сколько канал уже пропускал, — делили канал
+            capped = LINK_SATURATION * self.link_ceiling <= total <= self.link_ceiling / LINK_SATURATION
+            self.link_ceiling = max(self.link_ceiling, total)
+            if len(probed) > 1 and (dropped or capped):
+                limited = self.link_limited(probed)
+                self.log(f"[!] Группа замеров упёрлась в канал — {len(limited)} зеркал замеряю по одному")
+                waiting = [mirror for _, mirror in limited] + waiting
+                probed = [result for result in probed if result not in limited]
+                size = 1
+            else:
+                size = min(limit, size * 2)
+            groups.append((probed, total))
+            if not waiting and not rechecked:
+                # Потолок мог вырасти после ранних групп — те, что всё же в него упёрлись, — по одному
+                rechecked = True
+                for probed, total in groups:
+                    if len(probed) > 1 and total >= LINK_SATURATION * self.link_ceiling:
+                        limited = self.link_limited(probed)
+                        waiting += [mirror for _, mirror in limited]
+                        probed[:] = [result for result in probed if result not in limited]
+                limit = size = 1
+        results = [result for probed, _ in groups for result in probed]
+        for bench, _ in results:
+            bench["saturated"] = bench["throughput"] >= LINK_SATURATION * self.link_ceiling
+        if self.link_ceiling:
+            self.log(f"[+] Оценка потолка канала: {self.link_ceiling / 1048576:.1f} МБ/с")
+        return results
+
+    def link_limited(self, probed):
+        """
+        Замеры группы, которые мог срезать наш канал: он делится поровну,
+        так что упираются самые быстрые, а медленные берут своё. Сюда же —
+        просевшие против своего одиночного замера.
+        """
+        top = max(bench["throughput"] for bench, _ in probed)
+        return [(bench, mirror) for bench, mirror in probed
+                if bench["throughput"] >= LINK_SATURATION * top
+                or bench["throughput"] < LINK_SATURATION * self.solo_rates.get(mirror, 0)]
+
+    def effective_throughput(self, bench):
+        """
+        Скорость для сравнения зеркал: у упёршихся в наш канал она срезается
+        до LINK_SATURATION его потолка, и между ними решают задержки и
+        надёжность. Выше собственного замера зеркала не бывает.
+        """
+        if bench.get("saturated") and self.link_ceiling:
+            return min(bench["throughput"], LINK_SATURATION * self.link_ceiling)
+        return bench["throughput"]
+
+    async def _probe_mirrors_async(self, mirrors, probe, describe, workers, deadline, results):
+        """asyncio-вариант probe_mirrors: семафор на workers проверок, отмена по cancel_event."""
+        import asyncio
+        limit = asyncio.Semaphore(workers)
+
+        async def bounded(mirror):
+            async with limit:
+                return await probe(mirror)
+
+        loop = asyncio.get_running_loop()
+        tasks = {asyncio.ensure_future(bounded(mirror)): mirror for mirror in mirrors}
+        pending = set(tasks)
+        end = loop.time() + deadline
+        try:
+            while pending and not self.cancel_event.is_set():
+                remaining = end - loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=min(0.05, remaining),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    self._report_probe(results, tasks[task], task, describe)
+            if not self.cancel_event.is_set():
+                for task in pending:
+                    self.log(f"    ⌛ {tasks[task]} — не уложилось в {deadline} с")
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _report_probe(self, results, mirror, fut, describe):
+        """Пишет в лог и в results итог одной завершившейся проверки."""
+        try:
+            score = fut.result()
+        except Exception:
+            score = None
+        if score:
+            results.append((score, mirror))
+            self.log(f"    ✅ {mirror} — {describe(score)}")
+        else:
+            self.log(f"    ❌ {mirror} — не отвечает")
 
     def test_mirror(self, mirror, timeout=8):
         """
@@ -276,74 +1772,1007 @@ class MirrorApp:
         Возвращает скорость в байтах/сек, или None при ошибке.
         """
         url = f"{mirror.rstrip('/')}/dists/kali-rolling/main/binary-amd64/Packages.gz"
-        try:
-            start = time.time()
-            resp = requests.get(url, timeout=timeout, stream=True, allow_redirects=True)
-            if resp.status_code != 200:
+        # Соединение, открытое probe_release, — без повторного рукопожатия
+        bench = self.probe_client.fetch(url, PROBE_BYTES, timeout=timeout, reuse=True,
+                                        cancel_event=self.cancel_event)
+        if not bench:
+            return None
+        elapsed = sum(bench[phase] for phase in ("dns", "connect", "tls", "ttfb", "transfer"))
+        return bench["bytes"] / elapsed  # bytes per second
+
+    def benchmark_mirror(self, mirror, byte_budget=BENCH_BYTES, window=BENCH_WINDOW, timeout=8,
+                         path=BENCH_FILE, keep_body=False, reuse=False):
+        """
+        Подробный замер зеркала: отдельно время DNS, TCP-подключения, TLS,
+        до первого байта (TTFB) и устойчивая скорость после первого байта.
+        Качает path (по умолчанию BENCH_FILE) Range-запросом: не больше
+        byte_budget байт и не дольше window секунд. Возвращает dict с замерами
+        (и скачанными данными в "body", если keep_body) или None.
+        С reuse соединение остаётся открытым для следующей проверки (ProbeClient).
+        """
+        return self.probe_client.fetch(f"{mirror.rstrip('/')}/{path}", byte_budget, window=window,
+                                       timeout=timeout, keep_body=keep_body, reuse=reuse,
+                                       cancel_event=self.cancel_event)
+
+    def ssl_context(self):
+        """Один SSL-контекст (с CA-сертификатами certifi) на все замеры."""
+        import ssl
+        if not getattr(self, "_ssl_context", None):
+            import certifi
+            self._ssl_context = ssl.create_default_context(cafile=certifi.where())
+        return self._ssl_context
+
+    def score_benchmark(self, bench):
+        """
+        Итоговый балл зеркала: эффективная скорость (байт/с) загрузки файла
+        размером BENCH_REF_SIZE с учётом задержек, взвешенных по BENCH_WEIGHTS.
+        """
+        w = BENCH_WEIGHTS
+        seconds = sum(w[phase] * bench[phase] for phase in ("dns", "connect", "tls", "ttfb"))
+        seconds += w["throughput"] * BENCH_REF_SIZE / self.effective_throughput(bench)
+        return BENCH_REF_SIZE / seconds if seconds > 0 else 0.0
+
+    def describe_benchmark(self, bench):
+        ms = lambda phase: f"{bench[phase] * 1000:.0f}"
+        return (f"{bench['throughput'] / 1024:.0f} КБ/с, DNS {ms('dns')} мс, TCP {ms('connect')} мс, "
+                f"TLS {ms('tls')} мс, TTFB {ms('ttfb')} мс, балл {self.score_benchmark(bench):.0f}")
+
+    def rank_for_workload(self, ranked, files):
+        """
+        Переупорядочивает первые WORKLOAD_CANDIDATES зеркал из ranked по
+        прогнозу времени загрузки files (pending_downloads). Зеркала без
+        прогноза идут после них в прежнем порядке.
+        Возвращает (новый список зеркал, {зеркало: прогноз}).
+        """
+        candidates = ranked[:WORKLOAD_CANDIDATES]
+        sample = self.workload_sample(files)
+        total = sum(f["size"] for f in files)
+        self.log(f"[+] Прогноз для обновления: {len(files)} пакетов, {total / 1048576:.1f} МБ; "
+                 f"замер на {len(sample)} из них, {len(candidates)} зеркал")
+        probed = self.probe_bandwidth(
+            candidates,
+            probe=functools.partial(self.forecast_download, files=files, sample=sample),
+            describe=self.describe_forecast)
+        forecasts = {mirror: forecast for forecast, mirror in probed}
+        ordered = sorted(forecasts, key=lambda mirror: forecasts[mirror]["eta"])
+        return ordered + [mirror for mirror in ranked if mirror not in forecasts], forecasts
+
+    def workload_sample(self, files):
+        """До WORKLOAD_SAMPLE файлов, равномерно по размеру — от самого крупного."""
+        ordered = sorted(files, key=lambda f: f["size"], reverse=True)
+        step = len(ordered) / min(WORKLOAD_SAMPLE, len(ordered))
+        return [ordered[int(i * step)] for i in range(min(WORKLOAD_SAMPLE, len(ordered)))]
+
+    def forecast_download(self, mirror, files, sample):
+        """
+        Прогноз времени загрузки всех files с mirror одним соединением apt:
+        установка соединения, TTFB на каждый файл и объём на скорость,
+        измеренные на файлах sample. Возвращает dict с "eta" (секунды) или
+        None, если зеркало не отдало какой-то из файлов.
+        """
+        benches = []
+        for f in sample:
+            bench = self.benchmark_mirror(mirror, byte_budget=min(f["size"], WORKLOAD_SAMPLE_BYTES),
+                                          path=f["path"])
+            if not bench:
                 return None
-            chunk = next(resp.iter_content(chunk_size=10240), b'')
-            if not chunk:
+            benches.append(bench)
+        setup = min(b["dns"] + b["connect"] + b["tls"] for b in benches)
+        ttfb = sorted(b["ttfb"] for b in benches)[len(benches) // 2]
+        throughput = sum(b["bytes"] for b in benches) / sum(b["bytes"] / b["throughput"] for b in benches)
+        total = sum(f["size"] for f in files)
+        return {"eta": setup + len(files) * ttfb + total / throughput,
+                "throughput": throughput, "ttfb": ttfb}
+
+    def describe_forecast(self, forecast):
+        return (f"~{forecast['eta']:.0f} с ({forecast['throughput'] / 1024:.0f} КБ/с, "
+                f"TTFB {forecast['ttfb'] * 1000:.0f} мс)")
+
+    def validate_mirrors(self, mirrors, scores):
+        """
+        Параллельно запускает apt-get update для каждого из mirrors в своём
+        временном каталоге (Dir::State::Lists, Dir::Etc::SourceList).
+        Первое зеркало, чьи индексы скачались полностью и без ошибок,
+        записывается в sources.list, а его списки переносятся в APT_LISTS_DIR
+        без повторной загрузки. Возвращает это зеркало или None.
+        """
+        if not mirrors:
+            return None
+        self.log(f"[→] Параллельный apt-get update для {len(mirrors)} зеркал...")
+        workdirs = {mirror: self.make_apt_workdir(mirror) for mirror in mirrors}
+        source = self.current_sources_uri()
+        procs = {}
+        stop = threading.Event()
+        winner = None
+        pool = ThreadPoolExecutor(max_workers=len(mirrors))
+        futures = {pool.submit(self.isolated_update, mirror, workdirs[mirror], procs, stop, source): mirror
+                   for mirror in mirrors}
+        pending = set(futures)
+        try:
+            while pending and not winner and not self.cancel_event.is_set():
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    mirror = futures[fut]
+                    try:
+                        error = fut.result()
+                    except Exception as e:
+                        error = str(e)
+                    if error is None and winner is None:
+                        winner = mirror
+                        self.log(f"    ✅ {mirror} — индексы получены")
+                    elif error:
+                        self.log(f"    ❌ {mirror} — {error}")
+                        scores.record_failure(mirror)
+            # Остальные проверки больше не нужны
+            stop.set()
+            for proc in list(procs.values()):
+                if proc.poll() is None:
+                    self.stop_process(proc)
+            pool.shutdown(wait=True)
+            scores.save()
+            if winner and not self.cancel_event.is_set():
+                with self.apt_lock():
+                    self.set_sources_list(winner)
+                    moved = self.install_lists(os.path.join(workdirs[winner], "lists"), winner)
+                self.log(f"[OK] Перенесено {moved} файлов индексов в {APT_LISTS_DIR}")
+                return winner
+            return None
+        finally:
+            stop.set()
+            for workdir in workdirs.values():
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def apt_lock(self, paths=APT_LOCK_FILES):
+        """
+        Держит блокировки apt paths (по умолчанию APT_LOCK_FILES), пока
+        меняются sources.list и индексы в APT_LISTS_DIR: параллельный
+        apt-get update или upgrade не увидит их наполовину заменёнными. Наш собственный apt-get внутри
+        блока запускать нельзя — он будет ждать ту же блокировку.
+        Если apt занят другим процессом — исключение, ничего не меняем.
+        """
+        import fcntl
+        fds = []
+        try:
+            for path in paths:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o640)
+                fds.append(fd)
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raise Exception(f"apt занят другим процессом ({path}), попробуйте позже")
+            yield
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def make_apt_workdir(self, mirror):
+        """Временный каталог с отдельными sources.list и lists для одного зеркала."""
+        workdir = tempfile.mkdtemp(prefix="kali-mirror-gui-")
+        # apt качает от имени _apt — ему нужен доступ внутрь
+        os.chmod(workdir, 0o755)
+        os.makedirs(os.path.join(workdir, "lists", "partial"))
+        os.makedirs(os.path.join(workdir, "sources.list.d"))
+        with open(os.path.join(workdir, "sources.list"), "w") as f:
+            f.write(self.sources_line(mirror))
+        return workdir
+
+    def isolated_update(self, mirror, workdir, procs, stop, source=None):
+        """
+        apt-get update только для mirror, в каталоге workdir. Совпадающие
+        индексы зеркала source заранее переносятся из APT_LISTS_DIR
+        (transplant_lists), и apt докачивает только изменившиеся.
+        Возвращает None при успехе или описание ошибки.
+        """
+        if stop.is_set():
+            return "остановлено"
+        if source:
+            self.transplant_lists(source, mirror, os.path.join(workdir, "lists"))
+        cmd = [
+            "apt-get", "update",
+            "-o", f"Dir::Etc::SourceList={workdir}/sources.list",
+            "-o", f"Dir::Etc::SourceParts={workdir}/sources.list.d",
+            "-o", f"Dir::State::Lists={workdir}/lists",
+            # Общий кэш пакетов не трогаем — параллельные apt иначе будут его делить
+            "-o", "Dir::Cache::pkgcache=",
+            "-o", "Dir::Cache::srcpkgcache=",
+        ]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                start_new_session=True)
+        procs[mirror] = proc
+        if stop.is_set():
+            self.stop_process(proc)
+        detector = AptErrorDetector()
+        with proc.stdout:
+            for line in proc.stdout:
+                if detector.feed(line) and detector.fatal:
+                    # Зеркало уже не подходит — не ждём конца загрузки индексов
+                    self.stop_process(proc)
+                    break
+        proc.wait()
+        if stop.is_set():
+            return "остановлено"
+        if detector.fatal:
+            return f"{detector.fatal[0]}: {detector.fatal[1]}"
+        if proc.returncode != 0:
+            return f"apt-get update завершился с кодом {proc.returncode}"
+        lists = os.path.join(workdir, "lists")
+        if not glob.glob(os.path.join(lists, "*Release")) or not glob.glob(os.path.join(lists, "*_Packages*")):
+            return "индексы получены не полностью"
+        return None
+
+    def apt_list_prefix(self, uri):
+        """Начало имён файлов источника uri в lists — так же, как у apt (URItoFileName)."""
+        uri = re.sub(r"^[a-z0-9+.-]+:(//([^@/]*@)?)?", "", uri.rstrip('/') + "/dists/kali-rolling/")
+        quoted = "".join(f"%{b:02x}" if chr(b) in APT_QUOTE_CHARS or b <= 0x20 or b >= 0x7f else chr(b)
+                         for b in uri.encode("utf-8"))
+        return quoted.replace("/", "_")
+
+    def release_hashes(self, text):
+        """Раздел SHA256 файла Release/InRelease: {путь: (sha256, размер)}."""
+        hashes = {}
+        section = None
+        for line in text.splitlines():
+            if line.startswith("-----BEGIN PGP SIGNATURE"):
+                break
+            if line and not line[0].isspace():
+                section = line.partition(":")[0]
+            elif section == "SHA256":
+                fields = line.split()
+                if len(fields) == 3:
+                    hashes[fields[2]] = (fields[0], int(fields[1]))
+        return hashes
+
+    def transplant_lists(self, old, new, dest, src=APT_LISTS_DIR, new_uri=None):
+        """
+        Переносит индексы источника old (URI из sources.list) из src в dest
+        под именами зеркала new (или new_uri, если в sources.list он другой),
+        если они совпадают с тем, что new отдаёт сейчас: сверяются записи
+        SHA256 из свежего InRelease зеркала new и из сохранённого Release
+        источника old. Тогда apt-get update для new качает только InRelease.
+        Файлы связываются жёсткой ссылкой (или копируются), так что индексы
+        old остаются на месте, если new не подойдёт. Возвращает число файлов.
+        """
+        import requests
+        old_prefix = self.apt_list_prefix(old)
+        new_prefix = self.apt_list_prefix(new_uri or new)
+        if old_prefix == new_prefix and src == dest:
+            return 0
+        try:
+            resp = self.session.get(f"{new.rstrip('/')}/{RELEASE_FILE}", timeout=10)
+            resp.raise_for_status()
+        except requests.RequestException:
+            return 0
+        new_hashes = self.release_hashes(resp.text)
+        old_hashes = {}
+        for name in ("InRelease", "Release"):
+            try:
+                with open(os.path.join(src, old_prefix + name), encoding="utf-8", errors="replace") as f:
+                    old_hashes = self.release_hashes(f.read())
+                break
+            except OSError:
+                pass
+
+        moved = size = 0
+        for name in os.listdir(src):
+            if not name.startswith(old_prefix) or name.endswith("Release"):
+                continue
+            # Путь в Release: подчёркивания — это «/», буквальные «_» apt экранирует
+            stored = unquote(name[len(old_prefix):].replace("_", "/"))
+            base = stored
+            for ext in APT_LIST_COMPRESSION:
+                if stored.endswith(ext):
+                    base = stored[:-len(ext)]
+                    break
+            path = os.path.join(src, name)
+            expected = new_hashes.get(base)
+            if not expected:
+                continue
+            if old_hashes.get(base) != expected:
+                # Release старого зеркала нет — сверяем сам файл, если он не сжат
+                if base != stored or old_hashes:
+                    continue
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+                if (digest.hexdigest(), os.path.getsize(path)) != expected:
+                    continue
+            target = os.path.join(dest, new_prefix + name[len(old_prefix):])
+            if os.path.abspath(target) == os.path.abspath(path):
+                continue
+            try:
+                os.link(path, target + ".tmp")
+            except OSError:
+                shutil.copy2(path, target + ".tmp")
+            os.replace(target + ".tmp", target)
+            moved += 1
+            size += os.path.getsize(target)
+        if moved:
+            self.log(f"[+] {new}: {moved} индексов ({size / 1048576:.1f} МБ) взято из списков {old}")
+        return moved
+
+    def install_lists(self, lists, mirror):
+        """
+        Переносит скачанные для mirror индексы в APT_LISTS_DIR — под именами
+        того URI, что записан в sources.list (sources_uri). Старые файлы
+        других зеркал не удаляем: apt их не читает и сам уберёт при следующем update.
+        """
+        old_prefix = self.apt_list_prefix(mirror)
+        moved = 0
+        for name in os.listdir(lists):
+            path = os.path.join(lists, name)
+            if name != "lock" and os.path.isfile(path):
+                targets = [name]
+                if name.startswith(old_prefix):
+                    targets = self.list_targets(mirror, name[len(old_prefix):])
+                for target in targets[:-1]:
+                    shutil.copy2(path, os.path.join(APT_LISTS_DIR, target))
+                shutil.move(path, os.path.join(APT_LISTS_DIR, targets[-1]))
+                moved += 1
+        return moved
+
+    def list_targets(self, mirror, rest):
+        """
+        Имена в APT_LISTS_DIR для файла индексов mirror (rest — имя без
+        префикса зеркала). В режиме "sharded" InRelease нужен каждому
+        зеркалу раскладки, а индексы компонента — тому, кто его раздаёт.
+        """
+        if SOURCES_MODE == "sharded" and self.shards:
+            if rest.endswith("Release"):
+                return [self.apt_list_prefix(shard) + rest for shard, _ in self.shards]
+            component = rest.split("_", 1)[0]
+            targets = [self.apt_list_prefix(shard) + rest
+                       for shard, components in self.shards if component in components]
+            if targets:
+                return targets
+        return [self.apt_list_prefix(self.sources_uri(mirror)) + rest]
+
+    def prefetch_upgrade(self, mirrors):
+        """
+        Скачивает .deb для apt-get upgrade в APT_ARCHIVES_DIR заранее:
+        сразу с нескольких зеркал (mirrors[0] — записанное в sources.list),
+        крупные файлы первыми, самые большие — частями через Range.
+        Каждый файл сверяется с SHA256 из apt, так что apt-get upgrade
+        затем ставит пакеты из кэша без обращения к сети.
+        Возвращает число скачанных файлов.
+        """
+        files = self.pending_downloads(mirrors)
+        if not files:
+            return 0
+        total = sum(f["size"] for f in files)
+        self.log(f"[+] Предзагрузка: {len(files)} пакетов, {total / 1048576:.1f} МБ с {len(mirrors)} зеркал")
+        start = time.monotonic()
+
+        # partial/ и archives/ — под блокировкой apt: параллельный apt не почистит и
+        # не станет докачивать те же файлы, пока мы их пишем
+        with self.apt_lock([APT_ARCHIVES_LOCK]):
+            # Крупные первыми; каждую часть — на наименее загруженное зеркало
+            files.sort(key=lambda f: f["size"], reverse=True)
+            load = {mirror: 0 for mirror in mirrors}
+            tasks = []
+            partial = os.path.join(APT_ARCHIVES_DIR, "partial")
+            os.makedirs(partial, exist_ok=True)
+            for f in files:
+                f["tmp"] = os.path.join(partial, f["name"])
+                with open(f["tmp"], "wb") as out:
+                    out.truncate(f["size"])
+                if f["size"] > RANGE_SPLIT_SIZE:
+                    parts = [(offset, min(RANGE_PART_SIZE, f["size"] - offset))
+                             for offset in range(0, f["size"], RANGE_PART_SIZE)]
+                else:
+                    parts = [(0, f["size"])]
+                f["left"] = len(parts)
+                f["failed"] = False
+                for offset, length in parts:
+                    mirror = min(load, key=load.get)
+                    load[mirror] += length
+                    tasks.append((f, mirror, offset, length))
+
+            placed = 0
+            pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+            futures = {pool.submit(self.download_part, f, mirror, mirrors, offset, length): f
+                       for f, mirror, offset, length in tasks}
+            pending = set(futures)
+            try:
+                while pending and not self.cancel_event.is_set():
+                    done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        f = futures[fut]
+                        f["left"] -= 1
+                        if not fut.result():
+                            f["failed"] = True
+                        if f["left"] == 0:
+                            if not f["failed"] and self.place_download(f):
+                                placed += 1
+                            elif os.path.exists(f["tmp"]):
+                                os.remove(f["tmp"])
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+                for f in files:
+                    if f["left"] and os.path.exists(f["tmp"]):
+                        os.remove(f["tmp"])
+
+        elapsed = time.monotonic() - start
+        self.log(f"[+] Предзагружено {placed} из {len(files)} пакетов за {elapsed:.0f} с "
+                 f"({total / 1048576 / max(elapsed, 0.001):.1f} МБ/с)")
+        return placed
+
+    def pending_downloads(self, mirrors):
+        """
+        Список файлов, которые скачает apt-get upgrade (apt-get --print-uris):
+        dict с путём относительно зеркала, именем, размером и SHA256.
+        """
+        # Без ForceHash apt (2.6) оставляет колонку хэша пустой
+        proc = subprocess.run(["apt-get", "--print-uris", "-qq", "-o", "Acquire::ForceHash=SHA256", "upgrade"],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if proc.returncode != 0:
+            return []
+        files = []
+        uris = parsed = 0
+        # В режиме mirror+file apt печатает URI списка зеркал, а не самого зеркала
+        bases = list(mirrors) + [mirror for mirror, _ in self.shards]
+        bases += [uri for uri in (self.current_sources_uri(),) if uri]
+        for line in proc.stdout.splitlines():
+            uris += line.startswith("'")
+            match = re.match(r"^'([^']+)' (\S+) (\d+) SHA256:([0-9a-f]{64})", line)
+            if not match:
+                continue
+            parsed += 1
+            uri, name, size, sha256 = match.groups()
+            base = next((m for m in bases if uri.startswith(m.rstrip('/') + '/')), None)
+            if not base:
+                continue
+            dest = os.path.join(APT_ARCHIVES_DIR, name)
+            if os.path.exists(dest) and os.path.getsize(dest) == int(size):
+                continue
+            files.append({"path": uri[len(base.rstrip('/')) + 1:], "name": name,
+                          "size": int(size), "sha256": sha256})
+        if uris and not parsed:
+            self.log(f"[!] apt-get --print-uris: не разобрана ни одна из {uris} строк — "
+                     "предзагрузка и прогноз загрузки пропущены")
+        return files
+
+    def download_part(self, f, mirror, mirrors, offset, length):
+        """
+        Скачивает байты [offset, offset + length) файла f в f["tmp"] с зеркала
+        mirror; при ошибке пробует остальные mirrors. True при успехе.
+        """
+        import requests
+        whole = offset == 0 and length == f["size"]
+        headers = {} if whole else {"Range": f"bytes={offset}-{offset + length - 1}"}
+        for candidate in [mirror] + [m for m in mirrors if m != mirror]:
+            if self.cancel_event.is_set():
+                return False
+            try:
+                url = f"{candidate.rstrip('/')}/{f['path']}"
+                with self.session.get(url, headers=headers, stream=True, timeout=30) as resp:
+                    if resp.status_code != (200 if whole else 206):
+                        continue
+                    received = 0
+                    with open(f["tmp"], "r+b") as out:
+                        out.seek(offset)
+                        for chunk in resp.iter_content(chunk_size=1 << 20):
+                            if self.cancel_event.is_set():
+                                return False
+                            out.write(chunk[:length - received])
+                            received += len(chunk)
+                            if received >= length:
+                                break
+                if received >= length:
+                    return True
+            except (requests.RequestException, OSError):
+                continue
+        return False
+
+    def place_download(self, f):
+        """Сверяет SHA256 скачанного файла и переносит его в APT_ARCHIVES_DIR."""
+        digest = hashlib.sha256()
+        with open(f["tmp"], "rb") as src:
+            for block in iter(lambda: src.read(1 << 20), b""):
+                digest.update(block)
+        if digest.hexdigest() != f["sha256"]:
+            self.log(f"    ❌ {f['name']} — не совпала SHA256")
+            return False
+        os.chmod(f["tmp"], 0o644)
+        os.replace(f["tmp"], os.path.join(APT_ARCHIVES_DIR, f["name"]))
+        return True
+
+    def rerank(self, margin=SWITCH_MARGIN):
+        """
+        Один проход фоновой службы: заново оценивает все зеркала и переходит
+        на лучшее, только если его балл выше балла текущего зеркала больше
+        чем на margin. Переход проверяется apt-get update (validate_mirrors),
+        так что sources.list и индексы меняются вместе.
+        """
+        scores = ScoreCache()
+        results = self.rank_mirrors(self.load_mirrors(), scores, refresh=True)
+        if self.cancel_event.is_set():
+            return
+        if not results or results[0][0] <= 0:
+            # Без сети рейтинг не годится — окно должно проверить зеркала само
+            self.log("[!] Ни одно зеркало не прошло тест.")
+            return
+        state = self.load_daemon_state()
+        state["ranked_at"] = time.time()
+        self.save_daemon_state(state)
+
+        # Проверки шли без блокировки; менять зеркало посреди обновления из окна нельзя
+        run_lock = self.acquire_run_lock()
+        if run_lock is None:
+            self.log("[OK] Идёт обновление из окна — зеркало не меняем до следующего прохода")
+            return
+        try:
+            best_score, best = results[0]
+            current = self.current_mirror()
+            current_score = scores.score(current) if current else 0.0
+            self.ranking = results
+            if best == current:
+                self.log(f"[OK] Текущее зеркало по-прежнему лучшее: {current}")
+            elif current_score > 0 and best_score < current_score * (1 + margin):
+                self.log(f"[OK] {best} лучше текущего {current} меньше чем на {margin:.0%} — оставляем")
+            else:
+                self.log(f"[→] Переход: {current or '—'} ({current_score:.0f}) → {best} ({best_score:.0f})")
+                if self.validate_mirrors([best], scores):
+                    state["switched_at"] = time.time()
+                    self.save_daemon_state(state)
+                    return
+            # Первое зеркало прежнее, но запасные и их приоритеты — по свежему рейтингу
+            if SOURCES_MODE == "mirrorlist" and current and self.current_sources_uri() == self.sources_uri(current):
+                with self.apt_lock():
+                    self.write_mirror_list(current)
+        finally:
+            os.close(run_lock)
+
+    def acquire_run_lock(self, wait=False):
+        """
+        Блокировка RUN_LOCK_FILE (flock): окно держит её всё обновление,
+        фоновая служба — пока меняет зеркало. Возвращает дескриптор
+        (закрыть — снять блокировку) или None, если занято и wait не задан
+        или ожидание прервано отменой.
+        """
+        import fcntl
+        fd = os.open(RUN_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                pass
+            if not wait or self.cancel_event.is_set():
+                os.close(fd)
                 return None
-            elapsed = time.time() - start
-            if elapsed <= 0:
+            if not waiting:
+                self.log("[→] Фоновая служба сейчас меняет зеркало — ждём...")
+                waiting = True
+            self.cancel_event.wait(1)
+
+    def current_sources_uri(self):
+        """URI источника kali-rolling из /etc/apt/sources.list или None."""
+        try:
+            with open("/etc/apt/sources.list") as f:
+                for line in f:
+                    # Опции вида [arch=amd64 signed-by=...] пропускаем
+                    fields = re.sub(r"\[[^\]]*\]", " ", line).split()
+                    if len(fields) >= 3 and fields[0] == "deb" and fields[2] == "kali-rolling":
+                        return self.clean_url(fields[1])
+        except OSError:
+            pass
+        return None
+
+    def current_mirror(self):
+        """Текущее (первое в списке mirror+file) зеркало kali-rolling или None."""
+        uri = self.current_sources_uri()
+        if not uri or not uri.startswith("mirror+file:"):
+            return uri
+        try:
+            with open(uri[len("mirror+file:"):]) as f:
+                for line in f:
+                    fields = line.split()
+                    if fields and not fields[0].startswith("#"):
+                        return self.clean_url(fields[0])
+        except OSError:
+            pass
+        return None
+
+    def load_daemon_state(self):
+        try:
+            with open(DAEMON_STATE_FILE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_daemon_state(self, state):
+        tmp = DAEMON_STATE_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, DAEMON_STATE_FILE)
+
+    def sources_line(self, mirror, components=KALI_COMPONENTS):
+        return f"deb {mirror} kali-rolling {' '.join(components)}\n"
+
+    def sources_uri(self, mirror):
+        """Что записать в sources.list для mirror: список зеркал (mirror+file) или само зеркало."""
+        if SOURCES_MODE == "mirrorlist":
+            return f"mirror+file:{MIRROR_LIST_FILE}"
+        return mirror
+
+    def write_mirror_list(self, first):
+        """
+        Пишет MIRROR_LIST_FILE: first и следующие по рейтингу self.ranking
+        зеркала. Приоритет (меньше — раньше) растёт на 1 при каждом
+        двукратном отставании балла от лучшего: зеркала с близкими баллами
+        получают один приоритет, и apt делит загрузки между ними.
+        """
+        ranked = {mirror: score for score, mirror in self.ranking}
+        backups = [(score, mirror) for score, mirror in self.ranking if mirror != first and score > 0]
+        best = max([ranked.get(first, 0.0)] + [score for score, _ in backups])
+        entries = [(first, 1)]
+        for score, mirror in backups[:MIRROR_LIST_SIZE - 1]:
+            entries.append((mirror, 1 + int(math.log2(best / score))))
+        os.makedirs(os.path.dirname(MIRROR_LIST_FILE), exist_ok=True)
+        tmp = MIRROR_LIST_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("# Создан kali_mirror_gui.py по замерам; priority — меньше значит раньше\n")
+            for mirror, priority in entries:
+                f.write(f"{mirror}\tpriority:{priority}\n")
+        os.replace(tmp, MIRROR_LIST_FILE)
+        self.log(f"[OK] {MIRROR_LIST_FILE}: {len(entries)} зеркал")
+
+    def shard_plan(self, first):
+        """
+        Раскладка для режима "sharded": first и следующие по рейтингу зеркала
+        (до SHARD_MIRRORS), чьи записи SHA256 в InRelease сейчас совпадают
+        с first, — компоненты по кругу, main у first. Проверяется заново при
+        каждой записи sources.list. Возвращает [(зеркало, [компоненты])].
+        """
+        import requests
+        def hashes(mirror):
+            try:
+                resp = self.session.get(f"{mirror.rstrip('/')}/{RELEASE_FILE}", timeout=10)
+                resp.raise_for_status()
+            except requests.RequestException:
                 return None
-            return len(chunk) / elapsed  # bytes per second
-        except Exception:
-            return None
+            return self.release_hashes(resp.text)
+
+        shards = [first]
+        reference = hashes(first)
+        for score, mirror in self.ranking:
+            if not reference or len(shards) >= SHARD_MIRRORS:
+                break
+            if mirror in shards or score <= 0:
+                continue
+            if hashes(mirror) == reference:
+                shards.append(mirror)
+            else:
+                self.log(f"    ❌ {mirror} — InRelease не совпадает с {first}, в раскладку не входит")
+        plan = [(mirror, []) for mirror in shards]
+        for i, component in enumerate(KALI_COMPONENTS):
+            plan[i % len(plan)][1].append(component)
+        return plan
 
     def set_sources_list(self, mirror):
-        content = f"deb {mirror} kali-rolling main contrib non-free non-free-firmware\n"
+        if SOURCES_MODE == "mirrorlist":
+            self.write_mirror_list(mirror)
+        if SOURCES_MODE == "sharded":
+            self.shards = self.shard_plan(mirror)
+            content = "".join(self.sources_line(shard, components) for shard, components in self.shards)
+            self.log("[+] Компоненты по зеркалам: " +
+                     "; ".join(f"{' '.join(components)} — {shard}" for shard, components in self.shards))
+        else:
+            content = self.sources_line(self.sources_uri(mirror))
         tmp = "/tmp/sources.list"
         with open(tmp, "w") as f:
             f.write(content)
         shutil.move(tmp, "/etc/apt/sources.list")
         self.log("[OK] sources.list обновлён")
 
-    def run_cmd(self, cmd, check_apt_update=False):
+    def run_cmd(self, cmd, check_apt_update=False, fast=False):
+        """
+        Запускает cmd в своей группе процессов и читает вывод через selectors:
+        большими блоками, без блокировки на readline, с проверкой отмены
+        каждые CANCEL_POLL секунд. Вывод apt — в лог, прогресс — из
+        отдельного канала APT::Status-Fd. fast — добавить apt-get
+        FAST_INSTALL_OPTIONS.
+        """
         if self.cancel_event.is_set():
             return
         self.log(f"> {cmd}")
-        output_lines = []
+        args = cmd.split()
+        if fast and args[0] == "apt-get":
+            args += FAST_INSTALL_OPTIONS
+        self.install_started = None
+        detector = AptErrorDetector() if check_apt_update else None
+        status_r = status_w = None
+        sel = selectors.DefaultSelector()
         try:
+            if args[0] == "apt-get":
+                # Машиночитаемый прогресс apt — в отдельный канал, не в лог
+                status_r, status_w = os.pipe()
+                args += ["-o", f"APT::Status-Fd={status_w}"]
             proc = subprocess.Popen(
-                cmd.split(),
+                args,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                universal_newlines=True
+                bufsize=0,
+                pass_fds=(status_w,) if status_w is not None else (),
+                start_new_session=True
             )
             self.current_process = proc
-            for line in iter(proc.stdout.readline, ''):
+            sel.register(proc.stdout, selectors.EVENT_READ, self._output_line(detector))
+            if status_w is not None:
+                os.close(status_w)
+                status_w = None
+                sel.register(status_r, selectors.EVENT_READ, self._status_line())
+
+            streams = {key.fd: ["", codecs.getincrementaldecoder("utf-8")(errors="replace")]
+                       for key in sel.get_map().values()}
+            while streams:
                 if self.cancel_event.is_set():
-                    proc.terminate()
+                    self.stop_process(proc)
                     raise Exception("Отменено пользователем")
-                line = line.rstrip()
-                if line:
-                    self.log("  " + line)
-                    output_lines.append(line)
+                if detector and detector.fatal:
+                    # Первая фатальная ошибка apt-get update — сразу к следующему зеркалу
+                    self.stop_process(proc)
+                    kind, line = detector.fatal
+                    raise Exception(f"apt-get update прерван ({kind}): {line}")
+                for key, _ in sel.select(timeout=CANCEL_POLL):
+                    pending, decoder = streams[key.fd]
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        del streams[key.fd]
+                        text = pending + decoder.decode(b"", final=True)
+                        if text:
+                            key.data(text)
+                        continue
+                    *lines, streams[key.fd][0] = (pending + decoder.decode(data)).split("\n")
+                    for line in lines:
+                        key.data(line)
             proc.wait()
-            # Проверка "мягких" ошибок apt
-            if check_apt_update and proc.returncode == 0:
-                if any(
-                    phrase in line for line in output_lines
-                    for phrase in ["Не удалось получить", "Failed to fetch", "время ожидания", "timeout"]
-                ):
-                    raise Exception("apt-get update завершился с ошибками загрузки")
+            if self.cancel_event.is_set():
+                raise Exception("Отменено пользователем")
+            # Проверка "мягких" ошибок apt (последние строки могли прийти вместе с EOF)
+            if detector and detector.fatal:
+                raise Exception(f"apt-get update завершился с ошибкой ({detector.fatal[0]}): {detector.fatal[1]}")
             if proc.returncode != 0:
                 raise Exception(f"Команда завершилась с ошибкой: {cmd}")
         finally:
+            sel.close()
             self.current_process = None
+            for fd in (status_r, status_w):
+                if fd is not None:
+                    os.close(fd)
+            self.apt_progress = None
+            if self.install_report is not None and self.install_started is not None:
+                self.install_report["seconds"] += time.monotonic() - self.install_started
+
+    def _output_line(self, detector=None):
+        """Обработчик строк обычного вывода команды (и проверки ошибок apt-get update)."""
+        def handle(line):
+            line = line.rstrip()
+            if line:
+                self.log("  " + line)
+                if detector:
+                    detector.feed(line)
+        return handle
+
+    def _status_line(self):
+        """Обработчик строк APT::Status-Fd: публикует события в self.apt_progress."""
+        started = time.monotonic()
+
+        def handle(line):
+            nonlocal started
+            event = parse_apt_status(line)
+            if event is None:
+                return
+            if event.kind in ("error", "conffile"):
+                self.log(f"  [apt] {event.package}: {event.message}")
+                return
+            # Новая фаза (загрузка → установка) — ETA считаем заново
+            if self.apt_progress and self.apt_progress[0].kind != event.kind:
+                started = time.monotonic()
+            self.apt_progress = (event, started)
+            if event.kind == "install":
+                if self.install_started is None:
+                    self.install_started = time.monotonic()
+                if self.install_report is not None and event.package:
+                    self.install_report["packages"].add(event.package)
+        return handle
+
+    def fast_install_supported(self):
+        """Можно ли включать быструю установку: тип корневой ФС из FAST_INSTALL_FS."""
+        fstype = None
+        try:
+            with open("/proc/mounts") as f:
+                for line in f:
+                    fields = line.split()
+                    # Последняя запись для «/» — та, что видна сейчас
+                    if len(fields) >= 3 and fields[1] == "/":
+                        fstype = fields[2]
+        except OSError:
+            pass
+        if fstype in FAST_INSTALL_FS:
+            return True
+        self.log(f"[!] Быстрая установка отключена: корневая ФС {fstype or 'неизвестна'} — ставим как обычно")
+        return False
+
+    def report_install_time(self, fast):
+        """
+        Пишет в лог время установки пакетов. Средняя скорость установки
+        (сек на пакет) для обычного и быстрого режима хранится в
+        INSTALL_STATS_FILE; по ней оценивается, сколько сэкономлено.
+        """
+        seconds = self.install_report["seconds"]
+        count = len(self.install_report["packages"])
+        self.install_report = None
+        if not count:
+            return
+        try:
+            with open(INSTALL_STATS_FILE) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {}
+        mode, other = ("fast", "safe") if fast else ("safe", "fast")
+        rate = seconds / count
+        old = stats.get(mode)
+        stats[mode] = rate if old is None else INSTALL_RATE_MEMORY * old + (1 - INSTALL_RATE_MEMORY) * rate
+        tmp = INSTALL_STATS_FILE + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(INSTALL_STATS_FILE), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp, INSTALL_STATS_FILE)
+        except OSError as e:
+            # Статистика — только для оценки экономии: обновление из-за неё не прерываем
+            self.log(f"[!] Не удалось сохранить {INSTALL_STATS_FILE}: {e}")
+
+        msg = f"[+] Установка {count} пакетов заняла {seconds:.0f} с"
+        if other in stats:
+            # Сколько заняла бы та же установка в другом режиме
+            saved = stats["safe"] * count - seconds if fast else seconds - stats["fast"] * count
+            msg += (f"; быстрый режим сэкономил ~{saved:.0f} с" if fast
+                    else f"; в быстром режиме было бы ~{saved:.0f} с быстрее")
+        elif fast:
+            msg += " (для сравнения нужен хотя бы один запуск в обычном режиме)"
+        self.log(msg)
+
+def serve_cache(args):
+    """Режим --serve-cache: кэширующий прокси apt для других машин."""
+    from http.server import ThreadingHTTPServer
+    app = MirrorApp(None, require_root=False)
+    upstreams = args.upstream
+    if not upstreams:
+        ranked = app.rank_mirrors(app.load_mirrors(), ScoreCache())
+        upstreams = [mirror for _, mirror in ranked]
+    if not upstreams:
+        app.log("[!] Нет доступных зеркал для прокси.")
+        sys.exit(1)
+    store = CacheStore(args.cache_dir, args.cache_size * 1024 ** 3 if args.cache_size else None)
+    proxy = CachingProxy(app, store, upstreams)
+    server = ThreadingHTTPServer((args.bind, args.port), proxy.handler_class())
+    server.daemon_threads = True
+    app.log(f"[+] Кэширующий прокси на {args.bind}:{args.port}, кэш {store.root}, зеркала: {', '.join(upstreams[:3])}")
+    app.log(f"    На клиентах: deb http://<этот хост>:{args.port}/ kali-rolling main contrib non-free non-free-firmware")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_daemon(args):
+    """
+    Режимы --daemon и --rerank-once: фоновая переоценка зеркал без окна.
+    --rerank-once делает один проход (для systemd-таймера), --daemon
+    повторяет его каждые --interval секунд.
+    """
+    app = MirrorApp(None)
+    app.probe_workers = DAEMON_PROBE_CONCURRENCY
+    app.probe_deadline = DAEMON_PROBE_DEADLINE
+    # systemd останавливает службу через SIGTERM — прерываем проверки так же, как кнопкой «Отмена»
+    signal.signal(signal.SIGTERM, lambda *_: app.cancel_event.set())
+    while not app.cancel_event.is_set():
+        try:
+            app.rerank(args.margin)
+        except Exception as e:
+            app.log(f"[!] Ошибка: {e}")
+        if args.rerank_once:
+            break
+        app.cancel_event.wait(args.interval)
+
+
+def startup_report(budget_ms=STARTUP_BUDGET_MS):
+    """
+    Режим --startup-report: время импорта этого модуля в чистом
+    интерпретаторе (python -X importtime) против бюджета budget_ms и самые
+    дорогие из импортируемых им модулей. Код возврата 1 — бюджет превышен.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    code = f"import sys; sys.path.insert(0, {here!r}); import {module}"
+    # Меряем с готовым .pyc, как при обычной установке: первый прогон его записывает
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    subprocess.run([sys.executable, "-c", code], env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = (time.perf_counter() - start) * 1000
+    # import time: <свое, мкс> | <с вложенными, мкс> | <отступ по глубине><модуль>
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            rows.append((int(match[2]) / 1000, len(match[3]) // 2, match[4]))
+    total = next((ms for ms, depth, name in rows if name == module and depth == 0), None)
+    if proc.returncode != 0 or total is None:
+        print(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "❌ Импорт не удался")
+        return 1
+    print(f"Импорт {module}: {total:.1f} мс (бюджет {budget_ms} мс), "
+          f"весь запуск интерпретатора: {wall:.0f} мс")
+    # Модули, которые импортирует сам скрипт (глубина 1), — по убыванию стоимости
+    direct = sorted(((ms, name) for ms, depth, name in rows if depth == 1), reverse=True)
+    for ms, name in direct[:10]:
+        print(f"  {ms:7.1f} мс  {name}")
+    if total > budget_ms:
+        print(f"❌ Бюджет превышен на {total - budget_ms:.1f} мс")
+        return 1
+    print("✅ В пределах бюджета")
+    return 0
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Kali Mirror Updater")
+    parser.add_argument("--serve-cache", action="store_true",
+                        help="запустить кэширующий прокси apt для других машин")
+    parser.add_argument("--bind", default="0.0.0.0", help="адрес прокси (по умолчанию 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=CACHE_PROXY_PORT, help="порт прокси")
+    parser.add_argument("--upstream", action="append",
+                        help="зеркало для прокси (можно несколько); по умолчанию — лучшие по рейтингу")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="каталог кэша прокси")
+    parser.add_argument("--cache-size", type=int, help="предельный размер кэша прокси, ГБ")
+    parser.add_argument("--fast-install", action="store_true",
+                        help="быстрая установка пакетов (dpkg --force-unsafe-io, триггеры в конце)")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="замерить время импорта скрипта (python -X importtime) и выйти")
+    parser.add_argument("--daemon", action="store_true",
+                        help="фоновая служба: периодически переоценивать зеркала")
+    parser.add_argument("--rerank-once", action="store_true",
+                        help="один проход фоновой переоценки (для systemd-таймера)")
+    parser.add_argument("--interval", type=int, default=DAEMON_INTERVAL,
+                        help="период переоценки в режиме --daemon, сек")
+    parser.add_argument("--margin", type=float, default=SWITCH_MARGIN,
+                        help="на сколько (доля) новое зеркало должно быть лучше текущего")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup_report:
+        sys.exit(startup_report())
+    if args.serve_cache:
+        serve_cache(args)
+        return
+    if args.daemon or args.rerank_once:
+        run_daemon(args)
+        return
 
-def main():
-    if not GUI_AVAILABLE:
+    if not load_gui():
         print("⚠️  GUI недоступен — запускаю в режиме командной строки.")
         app = MirrorApp(None)
+        app.fast_install = app.fast_install or args.fast_install
         app.full_update_process()
         return
 
     root = tk.Tk()
     app = MirrorApp(root)
+    if args.fast_install:
+        app.fast_install_var.set(True)
     root.mainloop()
 
 if __name__ == "__main__":